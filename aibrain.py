@@ -16,6 +16,10 @@ HEADERS = {
     "Authorization": f"Bearer {GROQ_API_KEY}"
 }
 
+# Keep-alive session so each query reuses the TLS connection to Groq
+session = requests.Session()
+session.headers.update(HEADERS)
+
 # ========== AGENT STATE ==========
 agent_state = {
     "current_phase": "diagnostic",
@@ -37,7 +41,7 @@ def ai_query(prompt, system_msg="You are a helpful assistant.", max_tokens=500):
         "temperature": 0.7
     }
     try:
-        response = requests.post(API_URL, headers=HEADERS, json=payload)
+        response = session.post(API_URL, json=payload)
         response.raise_for_status()
         return response.json()["choices"][0]["message"]["content"].strip()
     except Exception as e:
@@ -3,14 +3,26 @@ import os
 import json
 import re
 import time
+import secrets
+import string
+import hashlib
+import copy
+import logging
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional, TypedDict, Annotated, Literal
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, TypedDict, Annotated, Literal
 from flask_cors import cross_origin
-from openai import OpenAI
+from openai import OpenAI, RateLimitError, APIConnectionError, InternalServerError
+import httpx
 import traceback 
-from flask import Flask, request, jsonify
+import threading
+import queue
+import atexit
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify, Response, stream_with_context, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from langchain_groq import ChatGroq
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import HumanMessage, AIMessage
@@ -20,21 +32,168 @@ import re
 
 # Third-party
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
+from lxml import html as lhtml
+from lxml.etree import ParserError
 import requests
+import orjson
+from cachetools import TTLCache
+from jinja2 import Environment, FunctionLoader, TemplateNotFound
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception_type
 import firebase_admin
 from firebase_admin import credentials, firestore, initialize_app
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
+from google.cloud.firestore_v1.field_path import FieldPath
 
 from langgraph.graph import StateGraph, END
 from langchain_groq import ChatGroq
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+
+# Compiled once for the JSON/score extraction helpers below
+_JSON_FENCE_RE = re.compile(r'```json\s*(\{.*?\})\s*```', re.DOTALL)
+_JSON_OBJECT_RE = re.compile(r'\{.*\}', re.DOTALL)
+_SCORE_RE = re.compile(r'(\d+)')
+_SCORE_100_RE = re.compile(r'(\d+)/100')
+_FENCE_RE = re.compile(r'```(?:json)?\s*(.*?)\s*(?:```|$)', re.DOTALL)
+_JSON_ARRAY_RE = re.compile(r'\[.*\]', re.DOTALL)
+
+
+def _strip_code_fence(text):
+    """Return the body of the first ``` / ```json block, or the stripped text if there is none."""
+    if "```" not in text:
+        return text.strip()
+    match = _FENCE_RE.search(text)
+    return match.group(1) if match else text.strip()
+
+
+class _JsonObjectTracker:
+    """
+    Follow streamed text chunk by chunk and find where the first top-level
+    JSON object starts and ends, tracking brace depth and string/escape state
+    so the buffer never has to be re-parsed to see whether it is complete.
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._length = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._member_start = None
+        self._member_spans = []
+        self.start = None
+        self.end = None
+
+    @property
+    def complete(self):
+        return self.end is not None
+
+    def feed(self, text):
+        offset = self._length
+        self._parts.append(text)
+        self._length += len(text)
+        if self.end is not None:
+            return
+        for i, ch in enumerate(text):
+            if self.start is None:
+                if ch == "{":
+                    self.start = offset + i
+                    self._member_start = self.start + 1
+                    self._depth = 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{" or ch == "[":
+                self._depth += 1
+            elif ch == "}" or ch == "]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.end = offset + i + 1
+                    self._member_spans.append((self._member_start, offset + i))
+                    return
+            elif ch == "," and self._depth == 1:
+                self._member_spans.append((self._member_start, offset + i))
+                self._member_start = offset + i + 1
+
+    def text(self):
+        return "".join(self._parts)
+
+    def object_text(self):
+        """The complete top-level object, or None if it has not closed yet."""
+        if self.end is None:
+            return None
+        return self.text()[self.start:self.end]
+
+    def take_members(self):
+        """
+        (key, value) pairs of the top-level object's members that have
+        finished since the last call, so they can be sent on before the
+        whole object closes.
+        """
+        if not self._member_spans:
+            return []
+        text = self.text()
+        members = []
+        for start, end in self._member_spans:
+            member = text[start:end].strip()
+            if not member:
+                continue
+            try:
+                members.extend(orjson.loads("{" + member + "}").items())
+            except orjson.JSONDecodeError:
+                continue
+        self._member_spans = []
+        return members
+
+
+def extract_json_object(text):
+    """
+    Parse the first balanced top-level {...} object in text, or return None.
+    One linear scan with _JsonObjectTracker; braces inside strings don't count.
+    """
+    tracker = _JsonObjectTracker()
+    tracker.feed(text)
+    if not tracker.complete:
+        return None
+    try:
+        return orjson.loads(tracker.object_text())
+    except orjson.JSONDecodeError:
+        return None
 
 load_dotenv()
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+log = logging.getLogger(__name__)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson, used by request.get_json() and
+    jsonify(). Datetimes and anything else orjson doesn't handle natively go
+    through Flask's default encoder, so response formats stay the same.
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(
+            obj,
+            default=self.default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        ).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app, resources={r"/*": {"origins": "*"}})  # CORS for all originsg
 
 # Load Firebase config from environment variable
@@ -55,32 +214,447 @@ if not firebase_admin._apps:
 # Firestore client
 db = firestore.client()
 
-def save_to_firebase(user_id, category, doc_id, data):
+# Background Firestore writes that should not hold up the response.
+# A single thread owns the BulkWriter: it drains whatever has queued up,
+# hands it all to the BulkWriter, then flushes, so bursts of writes are
+# committed together. The bounded queue applies backpressure when
+# Firestore falls behind. Failed writes are retried with BulkWriter's
+# exponential backoff up to WRITE_MAX_ATTEMPTS, then logged and dropped.
+_WRITE_QUEUE = queue.Queue(maxsize=1000)
+_WRITER_STOP = object()
+WRITE_MAX_ATTEMPTS = 10
+
+
+def _on_write_error(error, bulk_writer):
+    """BulkWriter error callback: True retries the write."""
+    if error.attempts < WRITE_MAX_ATTEMPTS:
+        return True
+    log.error("Dropping background write to %s after %d attempts: %s %s",
+              error.operation.reference.path, error.attempts, error.code, error.message)
+    return False
+
+
+def _bulk_write_loop():
+    bulk = db.bulk_writer(options=BulkWriterOptions(
+        initial_ops_per_second=500,
+        max_ops_per_second=10000
+    ))
+    bulk.on_write_error(_on_write_error)
+    while True:
+        items = [_WRITE_QUEUE.get()]
+        while True:
+            try:
+                items.append(_WRITE_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+
+        stop = False
+        for item in items:
+            if item is _WRITER_STOP:
+                stop = True
+                continue
+            doc_ref, data, merge = item
+            try:
+                bulk.set(doc_ref, data, merge=merge)
+            except Exception:
+                log.exception("Could not queue background write to %s", doc_ref.path)
+
+        try:
+            bulk.flush()
+        except Exception:
+            log.exception("Background write flush failed")
+
+        if stop:
+            bulk.close()
+            return
+
+
+_writer_thread = threading.Thread(target=_bulk_write_loop, name="firestore-writer", daemon=True)
+_writer_thread.start()
+
+
+def enqueue_write(doc_ref, data, merge=False):
+    """
+    Queue doc_ref.set(data, merge=merge) for the background writer.
+    BulkWriter commits in parallel and doesn't keep writes to one document in
+    order, so only use this for new, append-only documents, or for merges
+    whose result doesn't depend on order (ArrayUnion, SERVER_TIMESTAMP).
+    Other updates to users/{uid} go through enqueue_user_write.
+    """
+    _WRITE_QUEUE.put((doc_ref, data, merge))
+
+
+# Background writes that overwrite fields on a user's own document, where
+# the last write has to win. Each lane is a single thread and a user always
+# hashes to the same lane, so one user's writes land in the order this
+# process queued them.
+USER_WRITE_LANES = 8
+_user_write_lanes = [
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"user-writer-{i}")
+    for i in range(USER_WRITE_LANES)
+]
+
+
+def _log_user_write_error(future, path):
+    if future.exception() is not None:
+        log.error("Background write to %s failed: %s", path, future.exception())
+
+
+def enqueue_user_write(user_id, doc_ref, data, merge=False):
+    """
+    Queue doc_ref.set(data, merge=merge) on user_id's ordered write lane.
+    Returns the Future; callers that need to report a failed save can wait
+    on it, everyone else can ignore it (failures are logged).
+    """
+    lane = _user_write_lanes[hash(user_id) % USER_WRITE_LANES]
+    future = lane.submit(doc_ref.set, data, merge=merge)
+    future.add_done_callback(lambda f: _log_user_write_error(f, doc_ref.path))
+    return future
+
+
+@atexit.register
+def _flush_writes():
+    _WRITE_QUEUE.put(_WRITER_STOP)
+    _writer_thread.join(timeout=10)
+    for lane in _user_write_lanes:
+        lane.shutdown(wait=True)
+
+
+# The one thread pool for fanning out blocking Groq/Firestore calls.
+# Endpoints submit here instead of creating their own executors.
+IO_POOL = ThreadPoolExecutor(max_workers=32, thread_name_prefix="io")
+atexit.register(IO_POOL.shutdown, wait=False)
+
+def save_to_firebase(user_id, category, data, doc_id=None):
     """
-    Save a document under users/{user_id}/{category}/{doc_id}.
+    Save a document under users/{user_id}/{category}/{doc_id} (auto id when
+    doc_id is None). The write goes through the background writer, so the
+    request doesn't wait on Firestore.
     """
     if not user_id:
         return
     try:
         doc_ref = db.collection("users").document(user_id).collection(category).document(doc_id)
-        doc_ref.set(data)
-    except Exception as e:
-        print(f"[FIREBASE ERROR] {e}")
+        enqueue_write(doc_ref, data)
+    except Exception:
+        log.exception("save_to_firebase failed for %s/%s", user_id, category)
+
+
+# Chat messages are stored one document per message in a "messages"
+# subcollection of the chat document, ordered by "seq", so a turn only
+# writes the new messages. The chat document keeps "message_count".
+# Older chats still hold the whole history in an array field (legacy_field);
+# they are read from there and moved over on their next append.
+def load_chat_messages(doc_ref, doc_data, legacy_field):
+    """
+    Return (messages, persisted_count) for a chat document. persisted_count is
+    how many of the returned messages are already in the subcollection.
+    """
+    if doc_data.get("message_count") is not None:
+        messages = [
+            {"role": m["role"], "content": m["content"]}
+            for m in (snap.to_dict() for snap in doc_ref.collection("messages").order_by("seq").stream())
+        ]
+        return messages, len(messages)
+    return list(doc_data.get(legacy_field, [])), 0
+
+
+def get_latest_day_chat(chats, user_data):
+    """
+    Return the snapshot of the user's most recent custom_day_chat, or None.
+    Follows the latest_chat_id pointer on the user doc when it is set, and
+    falls back to the ordered query for users who predate the pointer.
+    """
+    latest_chat_id = (user_data or {}).get("latest_chat_id")
+    if latest_chat_id:
+        snap = chats.document(latest_chat_id).get()
+        if snap.exists:
+            return snap
+    docs = list(chats.order_by("day", direction=firestore.Query.DESCENDING).limit(1).stream())
+    return docs[0] if docs else None
+
 
+def append_chat_messages(batch, doc_ref, messages, start_seq, legacy_field):
+    """Add messages[start_seq:] to the chat's subcollection as part of batch."""
+    for seq in range(start_seq, len(messages)):
+        batch.set(doc_ref.collection("messages").document(f"{seq:06d}"), {
+            "role": messages[seq]["role"],
+            "content": messages[seq]["content"],
+            "seq": seq,
+            "ts": firestore.SERVER_TIMESTAMP
+        })
+    update = {"message_count": len(messages)}
+    if start_seq == 0:
+        update[legacy_field] = firestore.DELETE_FIELD
+    batch.set(doc_ref, update, merge=True)
+
+
+# One pooled HTTP/2 connection to Groq, shared by every request in this worker.
+# Connects fail fast; reads get the full minute long completions can take.
+groq_http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    timeout=httpx.Timeout(60.0, connect=5.0)
+)
 
 client = OpenAI(
     api_key=os.environ.get("GROQ_API_KEY"),
-    base_url="https://api.groq.com/openai/v1"
+    base_url="https://api.groq.com/openai/v1",
+    http_client=groq_http_client
+)
+
+
+@lru_cache(maxsize=256)
+def _client_for(api_key):
+    """Per-user-key view of the shared client, built once per key; shares its connection pool."""
+    return client.with_options(api_key=api_key)
+
+
+@lru_cache(maxsize=256)
+def _chat_groq_for(api_key, model, temperature):
+    """ChatGroq instance per key/settings, on the shared Groq connection pool."""
+    return ChatGroq(model=model, temperature=temperature, groq_api_key=api_key, http_client=groq_http_client)
+
+
+# Bounds concurrent Groq requests per worker so a burst of traffic queues
+# here instead of tripping the provider's rate limit
+GROQ_MAX_CONCURRENCY = int(os.environ.get("GROQ_MAX_CONCURRENCY", 32))
+_groq_slots = threading.BoundedSemaphore(GROQ_MAX_CONCURRENCY)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Groq while the circuit breaker is open."""
+
+
+class _CircuitBreaker:
+    """
+    Opens after `threshold` consecutive connection/5xx failures and rejects
+    calls for `cooldown` seconds. After that one trial call is let through
+    per cooldown until a call succeeds and closes it again.
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.cooldown:
+                raise CircuitOpenError("LLM provider unavailable, try again shortly")
+            self._opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+
+
+_groq_breaker = _CircuitBreaker(
+    threshold=int(os.environ.get("GROQ_BREAKER_THRESHOLD", 10)),
+    cooldown=float(os.environ.get("GROQ_BREAKER_COOLDOWN", 30))
+)
+
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, InternalServerError)),
+    reraise=True
 )
+def _call_llm(messages, llm_client=None, **kwargs):
+    """
+    Create a chat completion, retrying rate limits, connection errors and 5xx
+    with jittered exponential backoff instead of failing the request.
+    The SDK's own retries are disabled so the two don't stack. While Groq
+    keeps failing, the circuit breaker fails calls fast with CircuitOpenError.
+    With stream=True the result is a _SlotHeldStream, which keeps the
+    concurrency slot until the stream is drained or closed.
+    """
+    _groq_breaker.before_call()
+    llm_client = (llm_client or client).with_options(max_retries=0)
+    _groq_slots.acquire()
+    try:
+        response = llm_client.chat.completions.create(messages=messages, **kwargs)
+    except BaseException as e:
+        _groq_slots.release()
+        if isinstance(e, (APIConnectionError, InternalServerError)):
+            _groq_breaker.record_failure()
+        raise
+    if kwargs.get("stream"):
+        return _SlotHeldStream(response)
+    _groq_slots.release()
+    _groq_breaker.record_success()
+    return response
+
+
+class _SlotHeldStream:
+    """
+    A streamed completion that holds its _groq_slots slot until it has been
+    read to the end, failed or been closed, and reports how it ended to the
+    circuit breaker.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._released = False
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                yield chunk
+        except (APIConnectionError, InternalServerError, httpx.TransportError):
+            _groq_breaker.record_failure()
+            raise
+        else:
+            _groq_breaker.record_success()
+        finally:
+            self.close()
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            _groq_slots.release()
+            self._stream.close()
+
+
+def complete_with_token_cap(messages, max_tokens, retry_max_tokens, llm_client=None, **kwargs):
+    """
+    Generate with a tight max_tokens. If the output was cut off
+    (finish_reason == "length"), generate once more with retry_max_tokens.
+    """
+    response = _call_llm(messages, llm_client=llm_client, max_tokens=max_tokens, **kwargs)
+    if response.choices[0].finish_reason == "length":
+        response = _call_llm(messages, llm_client=llm_client, max_tokens=retry_max_tokens, **kwargs)
+    return response
+
+
+# In-process cache for low-temperature completions whose prompts recur
+# (profile generation, the chat12 history summary). Day plans, the AI helper
+# and the dashboard go through cached_complete with cache=False.
+# Entries expire after an hour and the oldest are evicted once the cache is
+# full. Hit/miss counts are served at /llm-cache-stats.
+LLM_CACHE_TTL = 3600
+LLM_CACHE_MAX_ENTRIES = 2048
+_llm_cache = {}
+_llm_cache_lock = threading.Lock()
+_llm_cache_stats = {"hits": 0, "misses": 0, "bypassed": 0}
+
+
+def cached_complete(model, messages, temperature, max_tokens, llm_client=None, response_format=None,
+                    cache=True):
+    """
+    Return the completion text for these inputs, reusing a cached answer when
+    the same request was made recently. Calls at temperature >= 0.5 are
+    sampled for variety and always go to the model, as do calls with
+    cache=False: user-facing generation the user may ask to regenerate.
+    """
+    extra = {"response_format": response_format} if response_format else {}
+    if not cache or temperature >= 0.5:
+        with _llm_cache_lock:
+            _llm_cache_stats["bypassed"] += 1
+        response = _call_llm(messages, llm_client=llm_client, model=model,
+                             temperature=temperature, max_tokens=max_tokens, **extra)
+        return response.choices[0].message.content
+
+    key = hashlib.sha256(orjson.dumps(
+        {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens, **extra},
+        option=orjson.OPT_SORT_KEYS
+    )).hexdigest()
+
+    now = time.monotonic()
+    with _llm_cache_lock:
+        hit = _llm_cache.get(key)
+        if hit and hit[0] > now:
+            _llm_cache_stats["hits"] += 1
+            return hit[1]
+        _llm_cache_stats["misses"] += 1
+
+    response = _call_llm(messages, llm_client=llm_client, model=model,
+                         temperature=temperature, max_tokens=max_tokens, **extra)
+    text = response.choices[0].message.content
+
+    with _llm_cache_lock:
+        _llm_cache.pop(key, None)
+        _llm_cache[key] = (now + LLM_CACHE_TTL, text)
+        while len(_llm_cache) > LLM_CACHE_MAX_ENTRIES:
+            _llm_cache.pop(next(iter(_llm_cache)))
+    return text
+
+
+def llm_cache_stats():
+    with _llm_cache_lock:
+        stats = dict(_llm_cache_stats, entries=len(_llm_cache))
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
 
 LOGS_FILE = "logs.json"
+# Rewards were kept here before rewards/{user_id}; read only to import them
 REWARD_FILE = "user_rewards.json"
 
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
+
+# Prompt files read through load_prompt; warmed at import so the first
+# request to each endpoint doesn't pay for the disk read.
+PROMPT_FILES = (
+    "prompt_setgoal.txt",
+    "prompt_location.txt",
+    "prompt_appreciation_coach.txt",
+    "prompt_mentor.txt",
+    "prompt_questions.txt",
+    "prompt_ai_helper_start.txt",
+    "prompt_ai_helper_reply.txt",
+    "prompt_dashboard.txt",
+    "prompt_reward_questions.txt",
+    "prompt_reward_analysis.txt",
+    "prompt_story_judge.txt",
+    "prompt_plan_01.txt",
+    "prompt_plan_02.txt",
+    "prompt_plan_03.txt",
+    "prompt_plan_04.txt",
+    "prompt_plan_05.txt",
+)
+
+@lru_cache(maxsize=None)
 def load_prompt(filename):
+    """Load a prompt template once per process, checking the working directory
+    first and then prompts/. Returns None if the file is missing.
+    Every prompt read in this module goes through here."""
+    for path in (filename, os.path.join(PROMPTS_DIR, filename)):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            continue
+    return None
+
+for _prompt_file in PROMPT_FILES:
+    load_prompt(_prompt_file)
+
+# Prompts with {{ placeholders }} are compiled once and rendered from the
+# cache; their source comes from load_prompt.
+JINJA_ENV = Environment(
+    loader=FunctionLoader(load_prompt),
+    auto_reload=False,
+    cache_size=-1,
+    keep_trailing_newline=True,
+)
+
+def render_prompt(filename, **values):
+    """Render a Jinja prompt template. Returns None if the file is missing."""
     try:
-        with open(filename, "r", encoding="utf-8") as f:
-            return f.read()
-    except FileNotFoundError:
+        return JINJA_ENV.get_template(filename).render(**values)
+    except TemplateNotFound:
         return None
 
 def read_logs():
@@ -96,15 +670,6 @@ def write_logs(logs):
     with open(LOGS_FILE, "w", encoding="utf-8") as f:
         json.dump(logs, f, indent=2)
 
-def read_rewards():
-    if not os.path.exists(REWARD_FILE):
-        return {}
-    with open(REWARD_FILE, "r", encoding="utf-8") as f:
-        try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            return {}
-
 def safe_format(template, **kwargs):
     """Safely format template with default values for missing keys"""
     class SafeDict(defaultdict):
@@ -136,58 +701,47 @@ def merge_places(existing, new):
     
     return merged
 
-def call_llm_with_retry(messages, temperature=0.6, max_tokens=500, max_retries=3):
-    """Call LLM API with retry logic"""
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                model="meta-llama/llama-4-scout-17b-16e-instruct",
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            if attempt == max_retries - 1:
-                raise
-            print(f"API call attempt {attempt + 1} failed: {e}")
-            continue
-    return None
+def call_llm_with_retry(messages, temperature=0.6, max_tokens=500):
+    """Call the LLM; retries and backoff are handled by _call_llm"""
+    response = _call_llm(
+        messages,
+        model="meta-llama/llama-4-scout-17b-16e-instruct",
+        temperature=temperature,
+        max_tokens=max_tokens
+    )
+    return response.choices[0].message.content.strip()
 
 def parse_json_response(text):
     """Parse JSON from LLM response, handling markdown code blocks"""
     try:
         # Remove markdown code blocks
-        if "```json" in text:
-            text = text.split("```json")[1].split("```")[0].strip()
-        elif "```" in text:
-            text = text.split("```")[1].split("```")[0].strip()
-        
-        return json.loads(text)
-    except json.JSONDecodeError as e:
+        text = _strip_code_fence(text)
+        return orjson.loads(text)
+    except orjson.JSONDecodeError as e:
         print(f"JSON parse error: {e}")
         print(f"Raw response: {text}")
         return None
 
 def load_prompt_file(filename, default_content=""):
-    """Load prompt file with fallback"""
-    try:
-        with open(filename, "r", encoding="utf-8") as f:
-            return f.read()
-    except FileNotFoundError:
+    """Load prompt file (cached) with fallback"""
+    prompt = load_prompt(filename)
+    if prompt is None:
         print(f"Warning: {filename} not found, using default")
         return default_content
-    except Exception as e:
-        print(f"Error reading {filename}: {e}")
-        return default_content
+    return prompt
 
-def truncate_chat_history(chat_history, max_messages=20):
-    """Truncate chat history to prevent token limit issues"""
+def truncate_chat_history(chat_history, max_messages=20, step=1):
+    """Truncate chat history to prevent token limit issues.
+    With step > 1 the cut point only moves in jumps of step messages, so the
+    kept messages stay the same prefix between jumps (at the cost of keeping
+    up to max_messages + step - 1)."""
     if len(chat_history) <= max_messages:
         return chat_history
     
-    # Keep first message (usually intro) and last N messages
-    return [chat_history[0]] + chat_history[-(max_messages-1):]
+    # Keep first message (usually intro) and the messages after the cut point
+    drop = len(chat_history) - max_messages
+    drop -= drop % step
+    return [chat_history[0]] + chat_history[1 + drop:]
 
 def create_initial_chat(user_id, goal_name="", user_interests=None):
     """Create initial chat document for user"""
@@ -209,9 +763,34 @@ def create_initial_chat(user_id, goal_name="", user_interests=None):
     
     return chat_doc
 
-def write_rewards(data):
-    with open(REWARD_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+def reward_ref(user_id):
+    """The user's current reward: rewards/{user_id}"""
+    return db.collection("rewards").document(user_id)
+
+@lru_cache(maxsize=1)
+def _legacy_rewards():
+    if not os.path.exists(REWARD_FILE):
+        return {}
+    with open(REWARD_FILE, "r", encoding="utf-8") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+def import_legacy_reward(user_id):
+    """
+    Copy a reward still pending in user_rewards.json into rewards/{user_id},
+    the first time that user's reward is looked up and not found. Never
+    overwrites a reward already in Firestore. Returns the reward or None.
+    """
+    reward = _legacy_rewards().get(user_id)
+    if reward is None:
+        return None
+    try:
+        reward_ref(user_id).create(reward)
+    except AlreadyExists:
+        return reward_ref(user_id).get().to_dict()
+    return reward
 
 def parse_story_analysis(analysis_text):
     """
@@ -219,13 +798,10 @@ def parse_story_analysis(analysis_text):
     Expected format from LLM should be JSON or structured text.
     """
     try:
-        # Try to parse as JSON first
-        import re
-        
-        # Look for JSON in the response
-        json_match = re.search(r'\{[\s\S]*\}', analysis_text)
+        # Look for JSON in the response first
+        json_match = _JSON_OBJECT_RE.search(analysis_text)
         if json_match:
-            analysis_json = json.loads(json_match.group(0))
+            analysis_json = orjson.loads(json_match.group(0))
             return analysis_json
         
         # If no JSON found, try to parse structured text manually
@@ -247,7 +823,7 @@ def parse_story_analysis(analysis_text):
             
             # Parse overall score
             if "overall score" in line.lower() or "overall:" in line.lower():
-                score_match = re.search(r'(\d+)', line)
+                score_match = _SCORE_RE.search(line)
                 if score_match:
                     analysis["overallScore"] = int(score_match.group(1))
             
@@ -282,7 +858,7 @@ def parse_story_analysis(analysis_text):
             # Parse content based on current section
             elif current_section in ["hook", "emotion", "details", "stakes", "resolution", "bridge"]:
                 if line:
-                    score_match = re.search(r'(\d+)/100', line)
+                    score_match = _SCORE_100_RE.search(line)
                     if score_match:
                         analysis["mechanics"][current_section]["score"] = int(score_match.group(1))
                     if "feedback:" in line.lower():
@@ -671,22 +1247,15 @@ def write_to_firebase(session_state):
 def extract_json_from_response(text):
     """Extract JSON from LLM response that might have markdown or extra text"""
     # Try to find JSON in markdown code blocks
-    json_match = re.search(r'```json\s*(\{.*?\})\s*```', text, re.DOTALL)
+    json_match = _JSON_FENCE_RE.search(text)
     if json_match:
         try:
-            return json.loads(json_match.group(1))
-        except json.JSONDecodeError:
+            return orjson.loads(json_match.group(1))
+        except orjson.JSONDecodeError:
             pass
     
     # Try to find raw JSON object
-    json_match = re.search(r'\{.*\}', text, re.DOTALL)
-    if json_match:
-        try:
-            return json.loads(json_match.group(0))
-        except json.JSONDecodeError:
-            pass
-    
-    return None
+    return extract_json_object(text)
 
 # ================== ENDPOINTS ==================
 
@@ -790,8 +1359,8 @@ def submit_phase_data():
         prompt_template_text = PHASE_PROMPTS.get(phase, PHASE_1_PROMPT)
         
         # Prepare the dynamic data as JSON strings
-        form_data_str = json.dumps(form_data, indent=2)
-        prev_data_str = json.dumps(session_state.get("phase_data", {}), indent=2)
+        form_data_str = orjson.dumps(form_data, option=orjson.OPT_INDENT_2).decode()
+        prev_data_str = orjson.dumps(session_state.get("phase_data", {}), option=orjson.OPT_INDENT_2).decode()
         
         # 4. Define the LLM Context Template
         context_template = """
@@ -812,11 +1381,7 @@ Analyze the form data, extract the required information according to your phase
         ])
         
         # 6. Invoke LLM
-        llm = ChatGroq(
-            model="llama-3.3-70b-versatile",
-            temperature=0.7,
-            groq_api_key=api_key
-        )
+        llm = _chat_groq_for(api_key, "llama-3.3-70b-versatile", 0.7)
         
         llm_output = llm.invoke(prompt.format_messages(
             prompt_text=prompt_template_text,
@@ -1038,17 +1603,13 @@ Respond according to your phase instructions.
         # Format with proper JSON serialization
         context = context_template.format(
             phase=phase,
-            collected_data_str=json.dumps(session_state.get("phase_data", {}), indent=2),
-            conversation_history_str=json.dumps(context_data["conversation_history"], indent=2),
+            collected_data_str=orjson.dumps(session_state.get("phase_data", {}), option=orjson.OPT_INDENT_2).decode(),
+            conversation_history_str=orjson.dumps(context_data["conversation_history"], option=orjson.OPT_INDENT_2).decode(),
             user_message=user_message
         )
         
         # Call LLM
-        llm = ChatGroq(
-            model="llama-3.3-70b-versatile",
-            temperature=0.7,
-            groq_api_key=api_key
-        )
+        llm = _chat_groq_for(api_key, "llama-3.3-70b-versatile", 0.7)
         
         full_prompt = f"{prompt_text}\n\n{context}"
         
@@ -1261,10 +1822,8 @@ def judge_story():
     
     try:
         # Load prompt template for story judging
-        try:
-            with open("prompt_story_judge.txt", "r") as f:
-                judge_prompt_template = f.read()
-        except FileNotFoundError:
+        judge_prompt_template = load_prompt("prompt_story_judge.txt")
+        if not judge_prompt_template:
             return jsonify({"error": "prompt_story_judge.txt not found"}), 500
         
         # Build system prompt
@@ -1277,7 +1836,7 @@ def judge_story():
         # Call LLM to analyze the story
         messages = [{"role": "system", "content": system_prompt}]
         
-        response = client.chat.completions.create(
+        response = _call_llm(
             model="meta-llama/llama-4-scout-17b-16e-instruct",
             messages=messages,
             temperature=0.7,
@@ -1293,8 +1852,8 @@ def judge_story():
         if not analysis_data or "overallScore" not in analysis_data:
             return jsonify({"error": "Failed to parse AI analysis"}), 500
         
-        # Save analysis to Firestore
-        db.collection("users").document(user_id).collection("storyJudgments").add({
+        # Save analysis to Firestore in the background; nothing reads it back here
+        enqueue_write(db.collection("users").document(user_id).collection("storyJudgments").document(), {
             "story_text": story_text,
             "scenario": scenario,
             "scenario_context": scenario_context,
@@ -1313,6 +1872,14 @@ def judge_story():
         
 
 
+# System prompt + recent turns sent to the model on each coaching message.
+# The window start only advances every CHAT_CONTEXT_STEP messages, so for
+# three turns at a time the history sent is an unchanged prefix plus the new
+# turns, which the provider's prompt cache can reuse.
+CHAT_CONTEXT_MESSAGES = 13
+CHAT_CONTEXT_STEP = 6
+
+
 @app.route('/api/chat/message', methods=['POST'])
 def chat_message():
     try:
@@ -1336,8 +1903,8 @@ def chat_message():
         if not api_key:
             return jsonify({"error": "Missing API key in Authorization header"}), 401
         
-        # Initialize client with provided API key
-        client.api_key = api_key
+        # Bind the user's API key to this request only
+        user_client = _client_for(api_key)
         
         # Generate conversation_id if not provided
         if not conversation_id:
@@ -1369,14 +1936,16 @@ def chat_message():
             "content": f"Current step: {chat_step}. {step_context}"
         }
         
-        # Build full message list for the AI
-        messages_for_model = [history[0], context_message] + history[1:]
-        messages_for_model.append({"role": "user", "content": user_message})
+        # Build the message list for the AI: the stored system prompt and the
+        # anchored window of recent turns, then the per-step context after it
+        messages_for_model = truncate_chat_history(history, CHAT_CONTEXT_MESSAGES, CHAT_CONTEXT_STEP)
+        messages_for_model = messages_for_model + [context_message, {"role": "user", "content": user_message}]
         
         # Call the LLaMA / Groq model
-        response = client.chat.completions.create(
+        response = _call_llm(
+            messages_for_model,
+            llm_client=user_client,
             model="groq/compound",
-            messages=messages_for_model,
             temperature=0.7,
             max_tokens=300
         )
@@ -1421,7 +1990,7 @@ def chat_message():
                 "timestamp": datetime.now().isoformat(),
                 "promptType": get_prompt_type(chat_step),
                 "metadata": {
-                    "messageId": f"msg_{int(time.time())}",
+                    "messageId": f"msg_{secrets.token_hex(8)}",
                     "aiModel": "groq/compound",
                     "tokensUsed": response.usage.total_tokens if hasattr(response, 'usage') else None
                 }
@@ -1439,111 +2008,280 @@ def chat_message():
         }), 500
 
 
+# Coaching step context and prompt type, indexed by chat step
+_STEP_CONTEXT_FMT = (
+    "User is sharing an initial example about {skill}. Ask them to identify specific qualities or actions.",
+    "User has shared qualities/actions. Now ask how they could express this genuinely.",
+    "User has practiced expression. Provide encouraging feedback and transition to scenarios.",
+    "User is ready for scenario practice. Wrap up the conversation warmly."
+)
+_STEP_TYPE = ("greeting", "dig_deeper", "practice_expression", "transition_to_scenarios")
+
+
 # Helper function: Get step-specific context
 def get_step_context(chat_step, skill_name):
     """Returns context based on current chat step"""
-    contexts = {
-        0: f"User is sharing an initial example about {skill_name}. Ask them to identify specific qualities or actions.",
-        1: "User has shared qualities/actions. Now ask how they could express this genuinely.",
-        2: "User has practiced expression. Provide encouraging feedback and transition to scenarios.",
-        3: "User is ready for scenario practice. Wrap up the conversation warmly."
-    }
-    return contexts.get(chat_step, "Continue the coaching conversation naturally.")
+    if isinstance(chat_step, int) and 0 <= chat_step < len(_STEP_CONTEXT_FMT):
+        return _STEP_CONTEXT_FMT[chat_step].format(skill=skill_name)
+    return "Continue the coaching conversation naturally."
 
 
 # Helper function: Get prompt type for frontend
 def get_prompt_type(chat_step):
     """Maps chat step to prompt type"""
-    types = {
-        0: "greeting",
-        1: "dig_deeper",
-        2: "practice_expression",
-        3: "transition_to_scenarios"
-    }
-    return types.get(chat_step, "general")
+    if isinstance(chat_step, int) and 0 <= chat_step < len(_STEP_TYPE):
+        return _STEP_TYPE[chat_step]
+    return "general"
 
 
-# Helper function: Load prompt file
-def load_prompt(filename):
-    """Load prompt template from file"""
+# Request models for the briefing endpoints. Strings are stripped before the
+# min_length check, so whitespace-only values are rejected like empty ones.
+class BriefingRequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    user_id: str = Field(min_length=1)
+    location: str = Field(min_length=1)
+    time: str = Field(min_length=1)
+    energy_level: int = 3
+    confidence_level: int = 3
+    user_history: Dict[str, Any] = Field(default_factory=dict)
+
+
+class OpenersRequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    user_id: str = Field(min_length=1)
+    location: str = Field(min_length=1)
+    confidence_level: int = 3
+    previous_openers: List[str] = Field(default_factory=list)
+
+
+class FavoriteOpenerRequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    user_id: str = Field(min_length=1)
+    opener_id: str = Field(min_length=1)
+
+
+def _validation_message(e):
+    """Flatten a pydantic ValidationError into one readable line."""
+    return "; ".join(
+        f"{'.'.join(str(p) for p in err['loc']) or 'body'}: {err['msg']}" for err in e.errors()
+    )
+
+
+@app.errorhandler(ValidationError)
+def handle_validation_error(e):
+    return jsonify({"error": f"Invalid request: {_validation_message(e)}"}), 400
+
+
+# Request model per endpoint name. For these endpoints the POST body is
+# decoded and validated in one pass before the view runs, and the model is
+# left in g.req; a bad body is answered with a 400 by the handler above.
+REQUEST_MODELS = {
+    "generate_briefing": BriefingRequest,
+    "generate_briefing_stream": BriefingRequest,
+    "regenerate_openers": OpenersRequest,
+    "save_favorite_opener": FavoriteOpenerRequest,
+}
+
+
+@app.before_request
+def validate_request_body():
+    model = REQUEST_MODELS.get(request.endpoint)
+    if model is not None and request.method == "POST":
+        g.req = model.model_validate_json(request.get_data())
+
+
+_TIME_FORMATS = ("%I:%M %p", "%I:%M%p", "%I %p", "%I%p", "%H:%M")
+
+
+def _time_bucket(value, minutes=15):
+    """Floor a clock time to a 15-minute bucket so nearby times share a cache entry."""
+    for fmt in _TIME_FORMATS:
+        try:
+            parsed = datetime.strptime(value.upper(), fmt)
+        except ValueError:
+            continue
+        floored = parsed.replace(minute=parsed.minute - parsed.minute % minutes)
+        return floored.strftime("%I:%M %p").lstrip("0")
+    # Free-form values like "evening" are used as-is
+    return value.lower()
+
+
+@lru_cache(maxsize=None)
+def _template_parts(filename):
+    """
+    Split a str.format-style prompt (from load_prompt) into (literal,
+    field_name) pairs once, so rendering is a join rather than a re-parse.
+    Raises FileNotFoundError if the prompt is missing.
+    """
+    text = load_prompt(filename)
+    if text is None:
+        raise FileNotFoundError(filename)
+    return tuple((literal, field) for literal, field, _, _ in string.Formatter().parse(text))
+
+
+def format_prompt(filename, **values):
+    """Render a pre-split prompt; equivalent to load_prompt(filename).format(**values)."""
+    return "".join(
+        literal if field is None else literal + str(values[field])
+        for literal, field in _template_parts(filename)
+    )
+
+
+def _build_briefing_prompt(location, time, energy_level, confidence_level,
+                           condensed_profile, user_history_json):
+    """Fill prompt_mission_briefing.txt with the user's context."""
+    return format_prompt(
+        "prompt_mission_briefing.txt",
+        location=location,
+        time=time,
+        energy_level=energy_level,
+        confidence_level=confidence_level,
+        condensed_profile=condensed_profile,
+        user_history=user_history_json
+    )
+
+
+def _sse_event(event, data):
+    """Format one server-sent event."""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+def _relay_stream(stream, on_complete):
+    """
+    Relay a streamed chat completion as SSE 'delta' events. Once the stream
+    ends, on_complete(full_text) builds the final payload, sent as 'done'.
+    """
+    buf = []
     try:
-        prompt_path = os.path.join(os.path.dirname(__file__), 'prompts', filename)
-        with open(prompt_path, 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        return None
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if delta:
+                buf.append(delta)
+                yield _sse_event("delta", {"content": delta})
+        yield _sse_event("done", on_complete("".join(buf)))
+    except Exception as e:
+        yield _sse_event("error", {"error": str(e)})
+    finally:
+        stream.close()
+
+
+def _sse_response(stream, on_complete):
+    """Stream a chat completion to the client through _relay_stream."""
+    response = Response(
+        stream_with_context(_relay_stream(stream, on_complete)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # Frees the Groq slot even if the client goes away before the body starts
+    response.call_on_close(stream.close)
+    return response
+
+
+# Generated briefings, kept for one BRIEFING_CACHE_TTL window of wall-clock
+# time. The window number is part of the key, so an entry is never reused on
+# another day even if the client sends the same clock time.
+BRIEFING_CACHE_TTL = 15 * 60
+_briefing_cache = TTLCache(maxsize=1024, ttl=BRIEFING_CACHE_TTL)
+_briefing_cache_lock = threading.Lock()
+
+
+def _generate_briefing_cached(user_id, location, time_of_day, energy_level, confidence_level,
+                              condensed_profile, user_history_json):
+    """
+    Generate a briefing for one set of inputs. Identical inputs whose client
+    time falls in the same 15-minute bucket, within the same wall-clock
+    window, are served from memory without calling the LLM. user_id is part
+    of the key so cached briefings never cross users. Returns a copy.
+    """
+    key = (
+        user_id, location, _time_bucket(time_of_day), energy_level, confidence_level,
+        condensed_profile, user_history_json, int(time.time() // BRIEFING_CACHE_TTL)
+    )
+    with _briefing_cache_lock:
+        briefing = _briefing_cache.get(key)
+    if briefing is None:
+        briefing = _generate_briefing(location, time_of_day, energy_level, confidence_level,
+                                      condensed_profile, user_history_json)
+        with _briefing_cache_lock:
+            _briefing_cache[key] = briefing
+    return copy.deepcopy(briefing)
+
+
+def _generate_briefing(location, time_of_day, energy_level, confidence_level,
+                       condensed_profile, user_history_json):
+    system_prompt = _build_briefing_prompt(
+        location, time_of_day, energy_level, confidence_level,
+        condensed_profile, user_history_json
+    )
+
+    # Call LLM to generate briefing
+    messages = [{"role": "system", "content": system_prompt}]
+
+    response = _call_llm(
+        messages,
+        model="meta-llama/llama-4-scout-17b-16e-instruct",
+        temperature=0.7,
+        max_tokens=2000,
+        response_format={"type": "json_object"}
+    )
+
+    # JSON mode guarantees a single JSON object, so no extraction is needed
+    return parse_briefing_response(response.choices[0].message.content)
+
 
 @app.route('/api/generate-briefing', methods=['POST', 'OPTIONS'])
 def generate_briefing():
     if request.method == 'OPTIONS':
         return '', 204
     
-    data = request.get_json()
-    user_id = data.get("user_id")
-    location = data.get("location", "").strip()
-    time = data.get("time", "").strip()
-    energy_level = data.get("energy_level", 3)
-    confidence_level = data.get("confidence_level", 3)
-    user_history = data.get("user_history", {})
-    
-    # Validation
-    if not user_id or not location or not time:
-        return jsonify({"error": "Missing required fields: user_id, location, time"}), 400
+    req = g.req
+    user_id = req.user_id
+    location = req.location
+    time = req.time
+    energy_level = req.energy_level
+    confidence_level = req.confidence_level
+    user_history = req.user_history
     
     try:
-        # Fetch user's condensed profile for personalization
-        user_doc = db.collection("users").document(user_id).get()
+        # Fetch only the condensed profile field for personalization
+        user_ref = db.collection("users").document(user_id)
+        user_doc = next(db.get_all([user_ref], field_paths=["condensed_profile"]))
         if not user_doc.exists:
             return jsonify({"error": "User not found"}), 404
         
         condensed_profile = user_doc.to_dict().get("condensed_profile", "")
+        if isinstance(condensed_profile, dict):
+            condensed_profile = orjson.dumps(condensed_profile, option=orjson.OPT_SORT_KEYS).decode()
         
-        # Load prompt template
         try:
-            with open("prompt_mission_briefing.txt", "r") as f:
-                briefing_prompt_template = f.read()
+            briefing_data = _generate_briefing_cached(
+                user_id,
+                location,
+                time,
+                energy_level,
+                confidence_level,
+                condensed_profile,
+                orjson.dumps(user_history, option=orjson.OPT_SORT_KEYS).decode()
+            )
         except FileNotFoundError:
             return jsonify({"error": "prompt_mission_briefing.txt not found"}), 500
         
-        # Build system prompt with user context
-        system_prompt = briefing_prompt_template.format(
-            location=location,
-            time=time,
-            energy_level=energy_level,
-            confidence_level=confidence_level,
-            condensed_profile=condensed_profile,
-            user_history=json.dumps(user_history)
-        )
-        
-        # Call LLM to generate briefing
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        response = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=2000
-        )
-        
-        briefing_text = response.choices[0].message.content.strip()
-        
-        # Parse the response into structured format
-        briefing_data = parse_briefing_response(briefing_text)
-        
         # Save briefing to user's Firestore document
-        db.collection("users").document(user_id).set(
-            {
-                "last_briefing": {
-                    "location": location,
-                    "time": time,
-                    "energy_level": energy_level,
-                    "confidence_level": confidence_level,
-                    "briefing_data": briefing_data,
-                    "created_at": firestore.SERVER_TIMESTAMP
-                }
-            },
-            merge=True
-        )
+        enqueue_user_write(user_id, db.collection("users").document(user_id), {
+            "last_briefing": {
+                "location": location,
+                "time": time,
+                "energy_level": energy_level,
+                "confidence_level": confidence_level,
+                "briefing_data": briefing_data,
+                "created_at": firestore.SERVER_TIMESTAMP
+            }
+        }, merge=True)
         
         return jsonify(briefing_data), 200
         
@@ -1551,57 +2289,211 @@ def generate_briefing():
         return jsonify({"error": str(e)}), 500
 
 
-# ============================================================================
-# ENDPOINT 2: Regenerate Openers Only
-# ============================================================================
-
-@app.route('/api/regenerate-openers', methods=['POST', 'OPTIONS'])
-def regenerate_openers():
+@app.route('/api/generate-briefing/stream', methods=['POST', 'OPTIONS'])
+def generate_briefing_stream():
+    """
+    Same as /api/generate-briefing, but relays tokens to the client as
+    server-sent events while Groq is still generating.
+    """
     if request.method == 'OPTIONS':
         return '', 204
     
-    data = request.get_json()
-    user_id = data.get("user_id")
-    location = data.get("location", "").strip()
-    confidence_level = data.get("confidence_level", 3)
-    previous_openers = data.get("previous_openers", [])
-    
-    if not user_id or not location:
-        return jsonify({"error": "Missing required fields: user_id, location"}), 400
+    req = g.req
+    user_id = req.user_id
+    location = req.location
+    time = req.time
+    energy_level = req.energy_level
+    confidence_level = req.confidence_level
+    user_history = req.user_history
     
     try:
-        # Fetch user profile
-        user_doc = db.collection("users").document(user_id).get()
+        user_ref = db.collection("users").document(user_id)
+        user_doc = next(db.get_all([user_ref], field_paths=["condensed_profile"]))
         if not user_doc.exists:
             return jsonify({"error": "User not found"}), 404
         
         condensed_profile = user_doc.to_dict().get("condensed_profile", "")
+        if isinstance(condensed_profile, dict):
+            condensed_profile = orjson.dumps(condensed_profile, option=orjson.OPT_SORT_KEYS).decode()
         
-        # Load openers prompt
         try:
-            with open("prompt_openers.txt", "r") as f:
-                openers_prompt_template = f.read()
+            system_prompt = _build_briefing_prompt(
+                location, time, energy_level, confidence_level,
+                condensed_profile, orjson.dumps(user_history, option=orjson.OPT_SORT_KEYS).decode()
+            )
         except FileNotFoundError:
-            return jsonify({"error": "prompt_openers.txt not found"}), 500
+            return jsonify({"error": "prompt_mission_briefing.txt not found"}), 500
         
-        system_prompt = openers_prompt_template.format(
-            location=location,
-            confidence_level=confidence_level,
-            condensed_profile=condensed_profile,
-            previous_opener_ids=",".join(previous_openers)
+        # JSON mode is not combined with streaming; the prompt asks for JSON only
+        stream = _call_llm(
+            [{"role": "system", "content": system_prompt}],
+            model="meta-llama/llama-4-scout-17b-16e-instruct",
+            temperature=0.7,
+            max_tokens=2000,
+            stream=True
+        )
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    
+    def on_complete(text):
+        briefing_data = extract_json_from_response(text)
+        if briefing_data is None:
+            return {"error": "Failed to parse briefing"}
+        enqueue_user_write(user_id, db.collection("users").document(user_id), {
+            "last_briefing": {
+                "location": location,
+                "time": time,
+                "energy_level": energy_level,
+                "confidence_level": confidence_level,
+                "briefing_data": briefing_data,
+                "created_at": firestore.SERVER_TIMESTAMP
+            }
+        }, merge=True)
+        return briefing_data
+    
+    return _sse_response(stream, on_complete)
+
+
+# Each item is a 2000-token LLM call on the shared IO_POOL; cap a request's
+# share so one batch can't starve the other endpoints
+BRIEFING_BATCH_MAX = 20
+
+
+@app.route('/api/generate-briefings-batch', methods=['POST', 'OPTIONS'])
+def generate_briefings_batch():
+    """
+    Generate briefings for several users in one request. Profiles are read in
+    a single Firestore round trip and the LLM calls run concurrently, so the
+    request takes about as long as the slowest briefing.
+    Each item in "results" has either "briefing" or "error".
+    """
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    items = data.get("users", [])
+    
+    if not items:
+        return jsonify({"error": "Missing required field: users"}), 400
+    if not isinstance(items, list) or len(items) > BRIEFING_BATCH_MAX:
+        return jsonify({"error": f"users must be a list of at most {BRIEFING_BATCH_MAX} requests"}), 400
+    
+    results = [None] * len(items)
+    pending = []
+    for i, item in enumerate(items):
+        try:
+            pending.append((i, BriefingRequest.model_validate(item)))
+        except ValidationError as e:
+            user_id = item.get("user_id") if isinstance(item, dict) else None
+            results[i] = {"user_id": user_id, "error": f"Invalid request: {_validation_message(e)}"}
+    
+    try:
+        refs = [db.collection("users").document(user_id) for user_id in {req.user_id for _, req in pending}]
+        profiles = {
+            snap.id: snap.to_dict().get("condensed_profile", "")
+            for snap in db.get_all(refs, field_paths=["condensed_profile"])
+            if snap.exists
+        } if refs else {}
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    
+    futures = []
+    for i, req in pending:
+        if req.user_id not in profiles:
+            results[i] = {"user_id": req.user_id, "error": "User not found"}
+            continue
+        condensed_profile = profiles[req.user_id]
+        if isinstance(condensed_profile, dict):
+            condensed_profile = orjson.dumps(condensed_profile, option=orjson.OPT_SORT_KEYS).decode()
+        future = IO_POOL.submit(
+            _generate_briefing_cached,
+            req.user_id,
+            req.location,
+            req.time,
+            req.energy_level,
+            req.confidence_level,
+            condensed_profile,
+            orjson.dumps(req.user_history, option=orjson.OPT_SORT_KEYS).decode()
         )
+        futures.append((i, req, future))
+    
+    saves = []
+    for i, req, future in futures:
+        try:
+            briefing_data = future.result()
+        except Exception as e:
+            results[i] = {"user_id": req.user_id, "error": str(e)}
+            continue
+        saves.append((i, enqueue_user_write(req.user_id, db.collection("users").document(req.user_id), {
+            "last_briefing": {
+                "location": req.location,
+                "time": req.time,
+                "energy_level": req.energy_level,
+                "confidence_level": req.confidence_level,
+                "briefing_data": briefing_data,
+                "created_at": firestore.SERVER_TIMESTAMP
+            }
+        }, merge=True)))
+        results[i] = {"user_id": req.user_id, "briefing": briefing_data}
+    
+    # The briefings were still generated; report a failed save per item
+    for i, save in saves:
+        try:
+            save.result()
+        except Exception as e:
+            results[i]["error"] = f"Failed to save to Firebase: {str(e)}"
+    
+    return jsonify({"results": results}), 200
+
+
+# ============================================================================
+# ENDPOINT 2: Regenerate Openers Only
+# ============================================================================
+
+@app.route('/api/regenerate-openers', methods=['POST', 'OPTIONS'])
+def regenerate_openers():
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    req = g.req
+    user_id = req.user_id
+    location = req.location
+    confidence_level = req.confidence_level
+    previous_openers = req.previous_openers
+    
+    try:
+        # Fetch only the condensed profile field
+        user_ref = db.collection("users").document(user_id)
+        user_doc = next(db.get_all([user_ref], field_paths=["condensed_profile"]))
+        if not user_doc.exists:
+            return jsonify({"error": "User not found"}), 404
+        
+        condensed_profile = user_doc.to_dict().get("condensed_profile", "")
+        
+        try:
+            system_prompt = format_prompt(
+                "prompt_openers.txt",
+                location=location,
+                confidence_level=confidence_level,
+                condensed_profile=condensed_profile,
+                previous_opener_ids=",".join(previous_openers)
+            )
+        except FileNotFoundError:
+            return jsonify({"error": "prompt_openers.txt not found"}), 500
         
         messages = [{"role": "system", "content": system_prompt}]
         
-        response = client.chat.completions.create(
+        response = _call_llm(
+            messages,
             model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=messages,
             temperature=0.8,
-            max_tokens=1200
+            max_tokens=1200,
+            response_format={"type": "json_object"}
         )
         
-        openers_text = response.choices[0].message.content.strip()
-        openers = parse_openers_response(openers_text)
+        openers = parse_openers_response(response.choices[0].message.content)
         
         return jsonify({"openers": openers}), 200
         
@@ -1618,22 +2510,16 @@ def save_favorite_opener():
     if request.method == 'OPTIONS':
         return '', 204
     
-    data = request.get_json()
-    user_id = data.get("user_id")
-    opener_id = data.get("opener_id")
-    
-    if not user_id or not opener_id:
-        return jsonify({"error": "Missing required fields: user_id, opener_id"}), 400
+    req = g.req
+    user_id = req.user_id
+    opener_id = req.opener_id
     
     try:
         # Add opener to user's favorite_openers array
-        db.collection("users").document(user_id).set(
-            {
-                "favorite_openers": firestore.ArrayUnion([opener_id]),
-                "last_favorite_saved": firestore.SERVER_TIMESTAMP
-            },
-            merge=True
-        )
+        enqueue_write(db.collection("users").document(user_id), {
+            "favorite_openers": firestore.ArrayUnion([opener_id]),
+            "last_favorite_saved": firestore.SERVER_TIMESTAMP
+        }, merge=True)
         
         return jsonify({
             "success": True,
@@ -1651,44 +2537,17 @@ def save_favorite_opener():
 def parse_briefing_response(text):
     """
     Parse the LLM response into structured briefing data.
-    The prompt should instruct the LLM to return JSON.
+    The request runs in JSON mode, so the content is a single JSON object.
     """
-    try:
-        # Try to extract JSON from the response
-        import re
-        json_match = re.search(r'\{.*\}', text, re.DOTALL)
-        if json_match:
-            return json.loads(json_match.group())
-        else:
-            # Fallback: return raw text in a structured format
-            return {
-                "venue_intel": {"raw_analysis": text},
-                "openers": [],
-                "scenarios": [],
-                "conversation_flows": [],
-                "cheat_sheet": text
-            }
-    except Exception as e:
-        return {
-            "error": "Failed to parse briefing",
-            "raw_response": text
-        }
+    return orjson.loads(text)
 
 
 def parse_openers_response(text):
     """
     Parse opener data from LLM response into structured format.
+    The request runs in JSON mode and the prompt wraps the list as {"openers": [...]}.
     """
-    try:
-        import re
-        json_match = re.search(r'\[.*\]', text, re.DOTALL)
-        if json_match:
-            return json.loads(json_match.group())
-        else:
-            # Fallback: return empty list
-            return []
-    except Exception as e:
-        return []
+    return orjson.loads(text).get("openers", [])
 
 
 
@@ -1714,7 +2573,7 @@ def save_briefing_session():
     try:
         db.collection("users").document(user_id).collection("briefing_history").add({
             "session_data": session_data,
-            "created_at": firestore.SERVER_TIMESTAMP
+            "created_at": datetime.utcnow()
         })
         
         return jsonify({
@@ -1753,24 +2612,25 @@ def anxiety_chat():
         if not api_key:
             return jsonify({"error": "Missing API key in Authorization header"}), 401
 
-        # Initialize client with provided API key
-        client.api_key = api_key
+        # Bind the user's API key to this request only
+        user_client = _client_for(api_key)
+
+        # The system prompt is not stored with the conversation; it is
+        # prepended on every call
+        system_prompt = load_prompt("prompt_anxiety_reduction.txt")
+        if system_prompt is None:
+            return jsonify({"error": "prompt_anxiety_reduction.txt not found"}), 500
 
         # Load conversation history from Firebase
         doc_ref = db.collection("anxiety_conversations").document(conversation_id)
         doc = doc_ref.get()
 
+        history, persisted_count = [], 0
         if doc.exists:
-            history = doc.to_dict().get("messages", [])
-        else:
-            # First time: load the anxiety reduction prompt
-            try:
-                with open("prompt_anxiety_reduction.txt", "r") as f:
-                    system_prompt = f.read()
-            except FileNotFoundError:
-                return jsonify({"error": "prompt_anxiety_reduction.txt not found"}), 500
-            
-            history = [{"role": "system", "content": system_prompt}]
+            history, persisted_count = load_chat_messages(doc_ref, doc.to_dict(), "messages")
+            # Legacy conversations stored the system prompt as their first message
+            if persisted_count == 0 and history and history[0]["role"] == "system":
+                history = history[1:]
 
         # Build context-aware message based on message_type
         if message_type == "greeting":
@@ -1825,9 +2685,10 @@ Give me encouraging analysis of my progress!"""
         history.append({"role": "user", "content": user_message})
 
         # Call the AI model
-        response = client.chat.completions.create(
+        response = _call_llm(
+            llm_client=user_client,
             model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=history,
+            messages=[{"role": "system", "content": system_prompt}] + history,
             temperature=0.7 if message_type == "user_message" else 0.6,
             max_tokens=500 if message_type == "user_message" else 300
         )
@@ -1838,12 +2699,10 @@ Give me encouraging analysis of my progress!"""
         suggestions = None
         if message_type == "self_talk_generation":
             try:
-                import json
                 # Try to extract JSON array from response
-                if "[" in ai_reply and "]" in ai_reply:
-                    json_start = ai_reply.index("[")
-                    json_end = ai_reply.rindex("]") + 1
-                    suggestions = json.loads(ai_reply[json_start:json_end])
+                array_match = _JSON_ARRAY_RE.search(ai_reply)
+                if array_match:
+                    suggestions = orjson.loads(array_match.group(0))
                 else:
                     # Fallback: split by newlines or bullets
                     suggestions = [line.strip("- •") for line in ai_reply.split("\n") if line.strip()][:4]
@@ -1858,12 +2717,14 @@ Give me encouraging analysis of my progress!"""
         # Append AI response to history
         history.append({"role": "assistant", "content": ai_reply})
 
-        # Save updated conversation to Firebase
-        doc_ref.set({
-            "messages": history,
+        # Save the new user + AI messages to Firebase
+        batch = db.batch()
+        append_chat_messages(batch, doc_ref, history, persisted_count, "messages")
+        batch.set(doc_ref, {
             "user_id": user_id,
-            "last_updated": firestore.SERVER_TIMESTAMP
+            "last_updated": datetime.utcnow()
         }, merge=True)
+        batch.commit()
 
         # Return response
         response_data = {"response": ai_reply}
@@ -1876,6 +2737,129 @@ Give me encouraging analysis of my progress!"""
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
 
+# Field name -> accepted aliases from the model, in priority order
+_LIVE_TASK_EXPECTED_KEYS = {
+    "title": ("title", "task_title", "name"),
+    "category": ("category", "type"),
+    "difficulty": ("difficulty", "level"),
+    "description": ("description", "overview"),
+    "totalSteps": ("totalSteps", "total_steps", "step_count"),
+    "estimatedTime": ("estimatedTime", "estimated_time", "duration"),
+    "xpReward": ("xpReward", "xp_reward", "xp"),
+    "prerequisites": ("prerequisites", "required_tasks"),
+    "tags": ("tags", "keywords"),
+    "steps": ("steps", "step_list"),
+    "relatedTasks": ("relatedTasks", "related_tasks"),
+    "aiMetadata": ("aiMetadata", "ai_metadata", "metadata")
+}
+_LIVE_TASK_ALIASES = {
+    alias: (canon, rank)
+    for canon, aliases in _LIVE_TASK_EXPECTED_KEYS.items()
+    for rank, alias in enumerate(aliases)
+}
+# Request-independent defaults; category, difficulty and aiMetadata come from the request
+_LIVE_TASK_DEFAULTS = {
+    "steps": [],
+    "prerequisites": [],
+    "tags": [],
+    "relatedTasks": [],
+    "xpReward": 150,
+    "totalSteps": 5,
+    "estimatedTime": "15 min"
+}
+
+
+def _build_live_action_task(parsed_task, user_id, task_name, category, difficulty,
+                            anxiety_level, specific_challenges):
+    """Turn the model's task JSON into the app's task structure. Returns (task_id, task_data)."""
+    # ========== STEP 5: Transform to App Structure ==========
+    # One pass over the model's keys; when several aliases of a field are
+    # present, the highest-priority one wins, and a missing or null field
+    # falls back to its default
+    chosen = {}
+    for key, value in parsed_task.items():
+        alias = _LIVE_TASK_ALIASES.get(key)
+        if alias is None:
+            continue
+        canon, rank = alias
+        if canon not in chosen or rank < chosen[canon][0]:
+            chosen[canon] = (rank, value)
+    
+    task_data = {}
+    for key in _LIVE_TASK_EXPECTED_KEYS:
+        value = chosen[key][1] if key in chosen else None
+        if value is None:
+            if key == "difficulty":
+                value = difficulty
+            elif key == "category":
+                value = category
+            elif key == "aiMetadata":
+                value = {
+                    "anxietyLevel": anxiety_level,
+                    "skillsTargeted": [],
+                    "commonChallenges": specific_challenges,
+                    "recommendedTimeOfDay": []
+                }
+            else:
+                value = copy.copy(_LIVE_TASK_DEFAULTS.get(key, ""))
+        task_data[key] = value
+    
+    # ========== STEP 6: Process and Validate Steps ==========
+    raw_steps = task_data.get("steps", [])
+    formatted_steps = []
+    
+    for idx, step in enumerate(raw_steps):
+        if isinstance(step, dict):
+            formatted_step = {
+                "id": idx + 1,
+                "title": step.get("title", f"Step {idx + 1}"),
+                "description": step.get("description", ""),
+                "tips": step.get("tips", []),
+                "examples": step.get("examples", []),
+                "aiCoaching": step.get("aiCoaching", step.get("ai_coaching", "")),
+                "xp": step.get("xp", 30),
+                "media": step.get("media", {
+                    "videoUrl": None,
+                    "imageUrl": None,
+                    "audioUrl": None
+                }),
+                "successCriteria": step.get("successCriteria", step.get("success_criteria", []))
+            }
+            formatted_steps.append(formatted_step)
+    
+    task_data["steps"] = formatted_steps
+    task_data["totalSteps"] = len(formatted_steps)
+    
+    # Calculate total XP if not provided
+    if task_data["xpReward"] == 150:  # Default value
+        task_data["xpReward"] = sum(step.get("xp", 30) for step in formatted_steps)
+    
+    # ========== STEP 7: Generate Unique Task ID ==========
+    # NOTE: Assuming 'datetime' module is available
+    task_id = f"{user_id}_{task_name.lower().replace(' ', '_')}_{int(datetime.now().timestamp())}"
+    task_data["id"] = task_id
+    task_data["created_at"] = datetime.now().isoformat()
+    task_data["user_id"] = user_id
+
+    return task_id, task_data
+
+
+def _save_live_action_task(user_id, task_id, task_data):
+    """Save to the user's live action tasks collection and the task library (shared tasks) in a single commit."""
+    task_ref = db.collection('users').document(user_id).collection('live_action_tasks').document(task_id)
+    library_ref = db.collection('task_library').document(task_id)
+    library_data = task_data.copy()
+    library_data["shared"] = False
+    library_data["creator_id"] = user_id
+    
+    batch = db.batch()
+    batch.set(task_ref, task_data)
+    batch.set(library_ref, library_data)
+    batch.commit()
+    print(f"✅ Saved to: users/{user_id}/live_action_tasks/{task_id}")
+    print(f"✅ Added to task library: task_library/{task_id}")
+
+
 # ============ LIVE ACTION SUPPORT ENDPOINT ============
 # ============ LIVE ACTION SUPPORT ENDPOINT ============
 @app.route("/live-action-support", methods=['POST'])
@@ -1899,7 +2883,7 @@ def live_action_support():
     api_key = request.headers.get("Authorization", "").replace("Bearer ", "").strip()
     if not api_key:
         return jsonify({"error": "Missing API key in Authorization header"}), 401
-    client.api_key = api_key
+    user_client = _client_for(api_key)
     
     # ========== STEP 2: Load User Profile for Personalization ==========
     user_profile = None
@@ -1916,8 +2900,8 @@ def live_action_support():
     # ========== STEP 3: Load Prompt Template ==========
     # NOTE: Assuming load_prompt and other dependencies (db, client, jsonify, request, json, datetime) are defined elsewhere
     prompt_file = "prompt_live_action_task.txt"
-    prompt_template = load_prompt(prompt_file) 
-    if not prompt_template:
+    prompt_template = load_prompt(prompt_file)
+    if prompt_template is None:
         return jsonify({"error": f"{prompt_file} not found"}), 404
     
     # Format challenges for prompt
@@ -1940,143 +2924,101 @@ def live_action_support():
             "preferred_time": user_profile.get("preferred_time", "morning")
         }
         # Assuming 'json' module is available for dumping stats
-        prompt += f"\n\nUser Statistics:\n{json.dumps(user_stats, indent=2)}"
+        prompt += f"\n\nUser Statistics:\n{orjson.dumps(user_stats, option=orjson.OPT_INDENT_2).decode()}"
     
+    # ========== STEP 4a: Optionally stream the generation as SSE ==========
+    if data.get("stream"):
+        try:
+            stream = _call_llm(
+                [{"role": "user", "content": prompt}],
+                llm_client=user_client,
+                model="groq/compound",
+                temperature=0.6,
+                max_tokens=6000,
+                stream=True
+            )
+        except Exception as e:
+            return jsonify({"error": "API request failed", "exception": str(e)}), 500
+
+        def generate():
+            # Relay tokens as they arrive; stop as soon as the top-level
+            # JSON object closes, then build and save the task once
+            tracker = _JsonObjectTracker()
+            try:
+                for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content or ""
+                    if not delta:
+                        continue
+                    tracker.feed(delta)
+                    yield _sse_event("delta", {"content": delta})
+                    if tracker.complete:
+                        break
+
+                if not tracker.complete:
+                    yield _sse_event("error", {
+                        "error": "Failed to parse task structure as JSON",
+                        "raw_response": tracker.text()
+                    })
+                    return
+
+                parsed_task = orjson.loads(tracker.object_text())
+                task_id, task_data = _build_live_action_task(
+                    parsed_task, user_id, task_name, category, difficulty, anxiety_level, specific_challenges
+                )
+                _save_live_action_task(user_id, task_id, task_data)
+                yield _sse_event("done", {
+                    "success": True,
+                    "task_id": task_id,
+                    "task": task_data,
+                    "message": f"Live action task '{task_name}' created successfully"
+                })
+            except Exception as e:
+                yield _sse_event("error", {"error": str(e)})
+            finally:
+                stream.close()
+
+        sse = Response(
+            stream_with_context(generate()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+        sse.call_on_close(stream.close)
+        return sse
+
     # ========== STEP 4: Generate AI Task Structure (FIX APPLIED HERE) ==========
     result = "" # Initialize result for scope outside try block
     try:
-        response = client.chat.completions.create(
+        response = complete_with_token_cap(
+            [{"role": "user", "content": prompt}],
+            max_tokens=2500,
+            retry_max_tokens=6000,
+            llm_client=user_client,
             model="groq/compound",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.6,
-            max_tokens=6000
+            temperature=0.6
         )
         result = response.choices[0].message.content.strip()
 
-        # 🔥 FIX: Remove Markdown code fences before parsing JSON
-        if result.startswith("```json"):
-            # Remove the leading "```json\n" and the trailing "\n```" (or just "```")
-            result = result.replace("```json\n", "", 1).strip().rstrip("`")
-        elif result.startswith("```"):
-            # Handle cases where the language tag is missing (e.g., just "```")
-            result = result.replace("```\n", "", 1).strip().rstrip("`")
-        
-        # Ensure only the JSON object remains
-        if result.endswith('```'):
-            result = result.rstrip('`').strip()
+        # Remove Markdown code fences before parsing JSON
+        result = _strip_code_fence(result)
 
-        parsed_task = json.loads(result)
+        parsed_task = orjson.loads(result)
         print(f"✅ Live action task structure generated from AI")
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         # Include the cleaned 'result' string for better debugging if the clean failed
         return jsonify({"error": "Failed to parse task structure as JSON", "raw_response": response.choices[0].message.content.strip(), "cleaned_result": result}), 500
     except Exception as e:
         return jsonify({"error": f"API request failed", "exception": str(e)}), 500
     
-    # ========== STEP 5: Transform to App Structure ==========
-    expected_keys = {
-        "title": ["title", "task_title", "name"],
-        "category": ["category", "type"],
-        "difficulty": ["difficulty", "level"],
-        "description": ["description", "overview"],
-        "totalSteps": ["totalSteps", "total_steps", "step_count"],
-        "estimatedTime": ["estimatedTime", "estimated_time", "duration"],
-        "xpReward": ["xpReward", "xp_reward", "xp"],
-        "prerequisites": ["prerequisites", "required_tasks"],
-        "tags": ["tags", "keywords"],
-        "steps": ["steps", "step_list"],
-        "relatedTasks": ["relatedTasks", "related_tasks"],
-        "aiMetadata": ["aiMetadata", "ai_metadata", "metadata"]
-    }
-    
-    task_data = {}
-    for key, alternatives in expected_keys.items():
-        value = None
-        for alt in alternatives:
-            if alt in parsed_task:
-                value = parsed_task[alt]
-                break
-        
-        # Provide sensible defaults
-        if value is None:
-            if key == "steps":
-                value = []
-            elif key == "prerequisites" or key == "tags" or key == "relatedTasks":
-                value = []
-            elif key == "xpReward":
-                value = 150
-            elif key == "totalSteps":
-                value = 5
-            elif key == "estimatedTime":
-                value = "15 min"
-            elif key == "difficulty":
-                value = difficulty
-            elif key == "category":
-                value = category
-            elif key == "aiMetadata":
-                value = {
-                    "anxietyLevel": anxiety_level,
-                    "skillsTargeted": [],
-                    "commonChallenges": specific_challenges,
-                    "recommendedTimeOfDay": []
-                }
-            else:
-                value = ""
-        task_data[key] = value
-    
-    # ========== STEP 6: Process and Validate Steps ==========
-    raw_steps = task_data.get("steps", [])
-    formatted_steps = []
-    
-    for idx, step in enumerate(raw_steps):
-        if isinstance(step, dict):
-            formatted_step = {
-                "id": idx + 1,
-                "title": step.get("title", f"Step {idx + 1}"),
-                "description": step.get("description", ""),
-                "tips": step.get("tips", []),
-                "examples": step.get("examples", []),
-                "aiCoaching": step.get("aiCoaching", step.get("ai_coaching", "")),
-                "xp": step.get("xp", 30),
-                "media": step.get("media", {
-                    "videoUrl": None,
-                    "imageUrl": None,
-                    "audioUrl": None
-                }),
-                "successCriteria": step.get("successCriteria", step.get("success_criteria", []))
-            }
-            formatted_steps.append(formatted_step)
-    
-    task_data["steps"] = formatted_steps
-    task_data["totalSteps"] = len(formatted_steps)
-    
-    # Calculate total XP if not provided
-    if task_data["xpReward"] == 150:  # Default value
-        task_data["xpReward"] = sum(step.get("xp", 30) for step in formatted_steps)
-    
-    # ========== STEP 7: Generate Unique Task ID ==========
-    # NOTE: Assuming 'datetime' module is available
-    task_id = f"{user_id}_{task_name.lower().replace(' ', '_')}_{int(datetime.now().timestamp())}"
-    task_data["id"] = task_id
-    task_data["created_at"] = datetime.now().isoformat()
-    task_data["user_id"] = user_id
+    # ========== STEPS 5-7: Transform to App Structure ==========
+    task_id, task_data = _build_live_action_task(
+        parsed_task, user_id, task_name, category, difficulty, anxiety_level, specific_challenges
+    )
     
     # ========== STEP 8: Save to Firebase ==========
-    # NOTE: Assuming 'db' (Firebase client) is available
     try:
-        # Save to user's live action tasks collection
-        task_ref = db.collection('users').document(user_id).collection('live_action_tasks').document(task_id)
-        task_ref.set(task_data)
-        print(f"✅ Saved to: users/{user_id}/live_action_tasks/{task_id}")
-        
-        # Also update user's task library (shared tasks)
-        library_ref = db.collection('task_library').document(task_id)
-        library_data = task_data.copy()
-        library_data["shared"] = False
-        library_data["creator_id"] = user_id
-        library_ref.set(library_data)
-        print(f"✅ Added to task library: task_library/{task_id}")
-        
+        _save_live_action_task(user_id, task_id, task_data)
     except Exception as e:
         return jsonify({"error": f"Failed to save to Firebase: {str(e)}"}), 500
     
@@ -2089,19 +3031,6 @@ def live_action_support():
     })
 
 
-# ============ HELPER FUNCTION FOR DIFFICULTY ==========
-def determine_difficulty(task_text):
-    """Determine difficulty based on task description"""
-    task_lower = task_text.lower()
-    
-    if any(word in task_lower for word in ['lead', 'present', 'speak to group', 'public']):
-        return 'Hard'
-    elif any(word in task_lower for word in ['conversation', 'share', 'ask question']):
-        return 'Medium'
-    else:
-        return 'Easy'
-
-
 # ============ TASK LIST OVERVIEW ENDPOINT ============
 @app.route('/create-task-overview', methods=['POST'])
 def create_task_overview():
@@ -2130,18 +3059,18 @@ def create_task_overview():
     course_id = goal_name.lower().replace(" ", "_")
 
     # Escape user inputs
-    safe_goal_name = json.dumps(goal_name)[1:-1]
-    safe_user_answers = json.dumps(user_answers)
+    safe_goal_name = _json_escaped(goal_name)
+    safe_user_answers = orjson.dumps(user_answers).decode()
     
     api_key = request.headers.get("Authorization", "").replace("Bearer ", "").strip()
     if not api_key:
         return jsonify({"error": "Missing API key in Authorization header"}), 401
-    client.api_key = api_key
+    user_client = _client_for(api_key)
 
     # ========== STEP 2: Load Task Overview Prompt ==========
     prompt_file = "prompt_task_overview.txt"
     prompt_template = load_prompt(prompt_file)
-    if not prompt_template:
+    if prompt_template is None:
         return jsonify({"error": f"{prompt_file} not found"}), 404
 
     # Insert user inputs
@@ -2150,28 +3079,20 @@ def create_task_overview():
 
     # ========== STEP 3: Generate Task Overview from AI ==========
     try:
-        response = client.chat.completions.create(
+        response = complete_with_token_cap(
+            [{"role": "user", "content": prompt}],
+            max_tokens=2500,
+            retry_max_tokens=4096,
+            llm_client=user_client,
             model="groq/compound",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.4,
-            max_tokens=4096
+            temperature=0.4
         )
         result = response.choices[0].message.content.strip()
     except Exception as e:
         return jsonify({"error": "API request failed", "exception": str(e)}), 500
 
     # Extract JSON
-    import re
-    def extract_json(text: str):
-        match = re.search(r'(\{.*\})', text, re.DOTALL)
-        if match:
-            try:
-                return json.loads(match.group(1))
-            except json.JSONDecodeError:
-                return None
-        return None
-
-    parsed_overview = extract_json(result)
+    parsed_overview = extract_json_object(result)
     if not parsed_overview:
         return jsonify({"error": "Failed to parse task overview as valid JSON", "raw_response": result}), 500
     
@@ -2238,110 +3159,111 @@ def reply_day_chat_advanced():
     if not api_key:
         return jsonify({"error": "Missing API key in Authorization header"}), 401
 
-    # Create a new client instance with the user's API key
-    user_client = OpenAI(
-        base_url="https://api.groq.com/openai/v1",
-        api_key=api_key
-    )
+    # Bind the user's API key to the shared, pooled client
+    user_client = _client_for(api_key)
 
     # ----------------------
     # FETCH EXISTING PLACES FROM FIREBASE
     # ----------------------
     user_doc_ref = db.collection("users").document(user_id)
+    chats = db.collection("users").document(user_id).collection("custom_day_chat")
     user_doc = user_doc_ref.get()
+    user_data = {}
     
     existing_current_places = []
     existing_desired_places = []
+    existing_profile_hash = None
+    existing_profile = {}
     
     if user_doc.exists:
         user_data = user_doc.to_dict()
         existing_current_places = user_data.get("current_places", [])
         existing_desired_places = user_data.get("desired_places", [])
+        existing_profile_hash = user_data.get("profile_history_hash")
+        existing_profile = user_data.get("condensed_profile", {})
 
     # ----------------------
-    # FETCH OR CREATE CHAT
+    # FETCH OR CREATE CHAT (direct lookup through latest_chat_id)
     # ----------------------
-    chats = db.collection("users").document(user_id).collection("custom_day_chat")
-    docs = list(chats.order_by("day", direction=firestore.Query.DESCENDING).limit(1).stream())
+    latest_chat = get_latest_day_chat(chats, user_data)
     
-    if not docs:
+    if latest_chat is None:
         # CREATE NEW CHAT AUTOMATICALLY
         new_chat_ref = chats.document()
         new_chat_ref.set({
             "day": firestore.SERVER_TIMESTAMP,
-            "chat": []
+            "message_count": 0
         })
-        chat_history = []
+        chat_history, persisted_count = [], 0
         doc_ref = new_chat_ref
     else:
-        doc_ref = docs[0].reference
-        chat_data = docs[0].to_dict()
-        chat_history = chat_data.get("chat", [])
+        doc_ref = latest_chat.reference
+        chat_history, persisted_count = load_chat_messages(doc_ref, latest_chat.to_dict(), "chat")
 
     # Append user message
     chat_history.append({"role": "user", "content": message})
 
     # Load chat prompt
-    try:
-        with open("prompt_DAYONE_COMPONENTONE.txt", "r") as f:
-            chat_prompt_template = f.read()
-    except FileNotFoundError:
+    system_prompt = load_prompt("prompt_DAYONE_COMPONENTONE.txt")
+    if system_prompt is None:
         return jsonify({"error": "prompt_DAYONE_COMPONENTONE.txt not found"}), 500
 
-    # Inject user-specific info into the prompt
-    system_prompt = chat_prompt_template.format(
-        goal_name=goal_name or "their personal goal",
-        user_places=", ".join(existing_current_places) if existing_current_places else "none",
-        user_interests=", ".join(user_interests) if user_interests else "none",
-        user_desired_places=", ".join(existing_desired_places) if existing_desired_places else "none"
+    # User-specific info changes every turn, so it goes in a trailing context
+    # message rather than the system prompt
+    context_message = {
+        "role": "system",
+        "content": (
+            "User context:\n"
+            f"Goal: {goal_name or 'their personal goal'}\n"
+            f"Known current places: {', '.join(existing_current_places) if existing_current_places else 'none'}\n"
+            f"Known interests: {', '.join(user_interests) if user_interests else 'none'}\n"
+            f"Places they want to go: {', '.join(existing_desired_places) if existing_desired_places else 'none'}"
+        )
+    }
+
+    # Static system prompt first, then the stored history, so the prefix is
+    # identical from turn to turn and stays in Groq's prompt cache
+    messages_for_model = (
+        [{"role": "system", "content": system_prompt}]
+        + chat_history[:-1]
+        + [context_message, chat_history[-1]]
     )
 
-    # Build messages - handle empty chat_history case
-    if len(chat_history) > 1:
-        # If there's prior history, insert system prompt after first message
-        context_message = {"role": "system", "content": system_prompt}
-        messages_for_model = [chat_history[0]] + [context_message] + chat_history[1:]
-    else:
-        # First message - just use system prompt + user message
-        messages_for_model = [
-            {"role": "system", "content": system_prompt},
-            chat_history[0]
-        ]
+    # Place extraction only needs the user's message
+    extraction_prompt_template = load_prompt("prompt_PLACE_EXTRACTION.txt")
+    if extraction_prompt_template is None:
+        return jsonify({"error": "prompt_PLACE_EXTRACTION.txt not found"}), 500
+
+    extraction_prompt = extraction_prompt_template.format(
+        user_message=message
+    )
 
     try:
-        # Generate AI chat reply
-        response = user_client.chat.completions.create(
+        # Generate the AI chat reply and EXTRACT PLACES concurrently
+        reply_future = IO_POOL.submit(
+            _call_llm,
+            llm_client=user_client,
             model="meta-llama/llama-4-scout-17b-16e-instruct",
             messages=messages_for_model,
             temperature=0.6,
             max_tokens=500
         )
+        extraction_future = IO_POOL.submit(
+            cached_complete,
+            "meta-llama/llama-4-scout-17b-16e-instruct",
+            [{"role": "system", "content": extraction_prompt}],
+            temperature=0.2,
+            max_tokens=200,
+            llm_client=user_client
+        )
+
+        response = reply_future.result()
         reply = response.choices[0].message.content.strip()
 
-        # Append AI response
+        # Append AI response (saved together with the profile below)
         chat_history.append({"role": "assistant", "content": reply})
-        doc_ref.update({"chat": chat_history})
-
-        # ----------------------
-        # EXTRACT PLACES using extraction prompt file
-        # ----------------------
-        try:
-            with open("prompt_PLACE_EXTRACTION.txt", "r") as f:
-                extraction_prompt_template = f.read()
-        except FileNotFoundError:
-            return jsonify({"error": "prompt_PLACE_EXTRACTION.txt not found"}), 500
 
-        extraction_prompt = extraction_prompt_template.format(
-            user_message=message
-        )
-
-        extraction_response = user_client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[{"role": "system", "content": extraction_prompt}],
-            temperature=0.2,
-            max_tokens=200
-        )
-        extraction_text = extraction_response.choices[0].message.content.strip()
+        extraction_text = extraction_future.result().strip()
 
         # Parse extraction
         newly_extracted_current = []
@@ -2349,16 +3271,13 @@ def reply_day_chat_advanced():
         
         try:
             # Clean markdown code blocks
-            if "```json" in extraction_text:
-                extraction_text = extraction_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in extraction_text:
-                extraction_text = extraction_text.split("```")[1].split("```")[0].strip()
+            extraction_text = _strip_code_fence(extraction_text)
             
-            extraction_data = json.loads(extraction_text)
+            extraction_data = orjson.loads(extraction_text)
             newly_extracted_current = extraction_data.get("current_places", [])
             newly_extracted_desired = extraction_data.get("desired_places", [])
             
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"Extraction parse error: {e}")
             print(f"Raw extraction response: {extraction_text}")
 
@@ -2366,64 +3285,86 @@ def reply_day_chat_advanced():
         # Merge with existing places (avoid duplicates, case-insensitive)
         # ----------------------
         def merge_places(existing, new):
-            existing_lower = [p.lower() for p in existing]
+            seen = {p.lower() for p in existing}
             merged = existing.copy()
             for place in new:
-                if place.lower() not in existing_lower:
+                place_lower = place.lower()
+                if place_lower not in seen:
+                    seen.add(place_lower)
                     merged.append(place)
             return merged
         
         updated_current_places = merge_places(existing_current_places, newly_extracted_current)
         updated_desired_places = merge_places(existing_desired_places, newly_extracted_desired)
 
+        # The *_str fields are the prompt-ready forms generate_user_places uses
+        user_update = {
+            "current_places": updated_current_places,
+            "desired_places": updated_desired_places,
+            "current_places_str": ", ".join(updated_current_places) or "none provided",
+            "desired_places_str": ", ".join(updated_desired_places) or "none provided",
+            "last_updated": datetime.utcnow()
+        }
+        if user_data.get("latest_chat_id") != doc_ref.id:
+            user_update["latest_chat_id"] = doc_ref.id
+
         # ----------------------
-        # Generate condensed profile using profile prompt file
+        # Generate condensed profile using profile prompt file.
+        # Skipped while the chat is still short, or when the recent messages
+        # are the same as when the stored profile was generated.
         # ----------------------
-        try:
-            with open("prompt_PROFILE_GENERATION.txt", "r") as f:
-                profile_prompt_template = f.read()
-        except FileNotFoundError:
-            return jsonify({"error": "prompt_PROFILE_GENERATION.txt not found"}), 500
-
-        profile_prompt = profile_prompt_template.format(
-            chat_history=json.dumps(chat_history, indent=2)
-        )
+        history_hash = hashlib.sha256(
+            orjson.dumps([m["content"] for m in chat_history[-6:]])
+        ).hexdigest()[:16]
+
+        if len(chat_history) >= 4 and history_hash != existing_profile_hash:
+            profile_prompt_template = load_prompt("prompt_PROFILE_GENERATION.txt")
+            if profile_prompt_template is None:
+                return jsonify({"error": "prompt_PROFILE_GENERATION.txt not found"}), 500
+
+            # The last 8 messages plus the previous profile keep this prompt a
+            # fixed size however long the chat gets
+            profile_prompt = profile_prompt_template.format(
+                chat_excerpt=orjson.dumps(chat_history[-8:]).decode(),
+                prior_profile=orjson.dumps(existing_profile).decode()
+            )
 
-        profile_response = user_client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[{"role": "system", "content": profile_prompt}],
-            temperature=0.3,
-            max_tokens=300
-        )
-        profile_text = profile_response.choices[0].message.content.strip()
+            profile_text = cached_complete(
+                "meta-llama/llama-4-scout-17b-16e-instruct",
+                [{"role": "system", "content": profile_prompt}],
+                temperature=0.3,
+                max_tokens=300,
+                llm_client=user_client
+            ).strip()
 
-        # Parse profile
-        profile_data = {}
-        try:
-            if "```json" in profile_text:
-                profile_text = profile_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in profile_text:
-                profile_text = profile_text.split("```")[1].split("```")[0].strip()
-            
-            profile_data = json.loads(profile_text)
-        except json.JSONDecodeError as e:
-            print(f"Profile parse error: {e}")
-            print(f"Raw profile response: {profile_text}")
-            profile_data = {"social_habits": "", "interests": [], "personality": ""}
+            # Parse profile
+            profile_data = {}
+            try:
+                profile_text = _strip_code_fence(profile_text)
+                
+                profile_data = orjson.loads(profile_text)
+            except orjson.JSONDecodeError as e:
+                print(f"Profile parse error: {e}")
+                print(f"Raw profile response: {profile_text}")
+                profile_data = {"social_habits": "", "interests": [], "personality": ""}
+
+            user_update.update({
+                "condensed_profile": profile_data,
+                "condensed_profile_str": orjson.dumps(profile_data).decode(),
+                "social_habits": profile_data.get("social_habits", ""),
+                "interests": profile_data.get("interests", []),
+                "personality": profile_data.get("personality", ""),
+                "comfort_level": profile_data.get("comfort_level", ""),
+                "profile_history_hash": history_hash
+            })
 
         # ----------------------
-        # Save everything to Firebase
+        # Save everything to Firebase in one commit
         # ----------------------
-        user_doc_ref.set({
-            "current_places": updated_current_places,
-            "desired_places": updated_desired_places,
-            "condensed_profile": profile_data,
-            "social_habits": profile_data.get("social_habits", ""),
-            "interests": profile_data.get("interests", []),
-            "personality": profile_data.get("personality", ""),
-            "comfort_level": profile_data.get("comfort_level", ""),
-            "last_updated": firestore.SERVER_TIMESTAMP
-        }, merge=True)
+        batch = db.batch()
+        append_chat_messages(batch, doc_ref, chat_history, persisted_count, "chat")
+        batch.set(user_doc_ref, user_update, merge=True)
+        batch.commit()
         
         return jsonify({
             "reply": reply,
@@ -2464,19 +3405,15 @@ def generate_user_places():
     if not api_key:
         return jsonify({"error": "Missing API key in Authorization header"}), 401
 
-    # Create a new client instance with the user's API key
-    user_client = OpenAI(
-        base_url="https://api.groq.com/openai/v1",
-        api_key=api_key
-    )
+    # Reuse the pooled module-level client with the user's API key
+    user_client = _client_for(api_key)
     
     # Fetch user data including places and profile
-    user_doc = db.collection("users").document(user_id).get()
+    user_snap = db.collection("users").document(user_id).get()
     
-    if not user_doc.exists:
+    if not user_snap.exists:
         return jsonify({"error": "User not found or profile not generated yet"}), 404
-    
-    user_data = user_doc.to_dict()
+    user_data = user_snap.to_dict()
     
     # CRITICAL: Fetch the places we extracted
     current_places = user_data.get("current_places", [])
@@ -2493,34 +3430,39 @@ def generate_user_places():
         }), 404
     
     # Load location prompt
-    try:
-        with open("prompt_location.txt", "r") as f:
-            location_prompt_template = f.read()
-    except FileNotFoundError:
+    # The instructions are the same for every user and go first, so the
+    # provider can reuse the cached prefix; user info follows in its own message
+    system_prompt = load_prompt("prompt_location.txt")
+    if not system_prompt:
         return jsonify({"error": "prompt_location.txt not found"}), 500
     
-    # Inject user info into location prompt INCLUDING PLACES
-    system_prompt = location_prompt_template.format(
+    # Prompt-ready strings are stored by the day chat when the profile and
+    # places change; older user docs fall back to serializing here
+    condensed_profile_str = user_data.get("condensed_profile_str")
+    if condensed_profile_str is None:
+        condensed_profile_str = orjson.dumps(condensed_profile).decode() if isinstance(condensed_profile, dict) else condensed_profile
+    user_context = render_prompt(
+        "prompt_location_context.txt",
         goal_name=goal_name or "their personal goal",
-        condensed_profile=json.dumps(condensed_profile) if isinstance(condensed_profile, dict) else condensed_profile,
-        user_current_places=", ".join(current_places) if current_places else "none provided",
-        user_desired_places=", ".join(desired_places) if desired_places else "none provided"
+        condensed_profile=condensed_profile_str,
+        user_current_places=user_data.get("current_places_str") or ", ".join(current_places) or "none provided",
+        user_desired_places=user_data.get("desired_places_str") or ", ".join(desired_places) or "none provided"
     )
+    if not user_context:
+        return jsonify({"error": "prompt_location_context.txt not found"}), 500
     
-    messages_for_model = [{"role": "system", "content": system_prompt}]
-    
-    try:
-        response = user_client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=messages_for_model,
-            temperature=0.7,  # Increased for more creative location suggestions
-            max_tokens=1500   # Increased to allow full JSON response with 3 locations
-        )
-        
-        suggested_places = response.choices[0].message.content.strip()
+    messages_for_model = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_context}
+    ]
+
+    def on_complete(text):
+        suggested_places = text.strip()
         
         # Save suggested places back to user doc
-        db.collection("users").document(user_id).set(
+        enqueue_user_write(
+            user_id,
+            db.collection("users").document(user_id),
             {
                 "suggested_places": suggested_places,
                 "places_generated_at": firestore.SERVER_TIMESTAMP
@@ -2528,17 +3470,30 @@ def generate_user_places():
             merge=True
         )
         
-        return jsonify({
+        return {
             "suggested_places": suggested_places,
             "used_data": {
                 "current_places": current_places,
                 "desired_places": desired_places
             }
-        })
+        }
+    
+    try:
+        response = _call_llm(
+            llm_client=user_client,
+            model="meta-llama/llama-4-scout-17b-16e-instruct",
+            messages=messages_for_model,
+            temperature=0.7,  # Increased for more creative location suggestions
+            max_tokens=1500,  # Increased to allow full JSON response with 3 locations
+            stream=bool(data.get("stream"))
+        )
+        if data.get("stream"):
+            return _sse_response(response, on_complete)
+        
+        return jsonify(on_complete(response.choices[0].message.content))
         
     except Exception as e:
-        import traceback
-        print(traceback.format_exc())
+        log.exception("generate_user_places failed for %s", user_id)
         return jsonify({"error": str(e)}), 500
         
 
@@ -2553,6 +3508,69 @@ CONVERSATION_STATES = [
     "final_goal"     # Goal Confirmation
 ]
 
+# chat12 keeps the system prompt, a rolling summary and only the recent
+# messages. Once CHAT12_SUMMARY_BATCH messages have piled up beyond the last
+# CHAT12_WINDOW they are folded into the summary and dropped from the doc, so
+# the prompt never grows past window + batch messages.
+CHAT12_WINDOW = 10
+CHAT12_SUMMARY_BATCH = 6
+
+def _summarize_chat12(summary, messages, llm_client):
+    """Fold messages into the running conversation summary."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    return cached_complete(
+        "meta-llama/llama-4-scout-17b-16e-instruct",
+        [{
+            "role": "user",
+            "content": (
+                "Update this summary of a goal-setting conversation with the new messages. "
+                "Keep every concrete fact about the user (situation, habits, people, obstacles, "
+                "resources, motivation, goal). Reply with the summary only, under 200 words.\n\n"
+                f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"
+            )
+        }],
+        temperature=0.2,
+        max_tokens=400,
+        llm_client=llm_client
+    ).strip()
+
+def _next_chat12_state(state):
+    """The state after state; the final state remains."""
+    index = CONVERSATION_STATES.index(state)
+    return CONVERSATION_STATES[min(index + 1, len(CONVERSATION_STATES) - 1)]
+
+@firestore.transactional
+def _commit_chat12_turn(transaction, doc_ref, conversation, turn, ai_message, folded=(), summary=None):
+    """
+    Append one user/assistant turn to the conversation doc inside a
+    transaction. conversation is the doc as this request read it (with its
+    system prompt), used only if the doc doesn't exist yet. Otherwise the
+    state, states and summary are taken from the stored doc, so a turn that
+    raced another request never moves the state machine backwards.
+    folded are the oldest non-system messages that went into summary; they
+    are dropped only if they are still the oldest stored messages, and
+    summary replaces the stored one only then. The LLM calls stay outside:
+    transactions can be retried.
+    """
+    snap = doc_ref.get(transaction=transaction)
+    stored = snap.to_dict() if snap.exists else conversation
+    state = stored.get("current_state", "context")
+    states = dict(stored.get("states") or {s: "" for s in CONVERSATION_STATES})
+    states[state] = ai_message
+    messages = stored.get("messages", []) + turn
+    stored_summary = stored.get("summary", "")
+    if folded and summary is not None and messages[1:1 + len(folded)] == list(folded):
+        messages = messages[:1] + messages[1 + len(folded):]
+        stored_summary = summary
+    conversation = {
+        "messages": messages,
+        "states": states,
+        "current_state": _next_chat12_state(state),
+        "summary": stored_summary
+    }
+    transaction.set(doc_ref, conversation)
+    return state, conversation
+
 @app.route('/chat12', methods=['POST'])
 def chat12_endpoint():
     try:
@@ -2572,16 +3590,17 @@ def chat12_endpoint():
         if not api_key:
             return jsonify({"error": "Missing API key in Authorization header"}), 401
 
-        client.api_key = api_key
+        user_client = _client_for(api_key)
 
         # Load conversation from Firebase
         doc_ref = db.collection("conversations").document(user_id)
-        doc = doc_ref.get()
-        if doc.exists:
-            doc_data = doc.to_dict()
+        doc_snap = doc_ref.get()
+        if doc_snap.exists:
+            doc_data = doc_snap.to_dict()
             history = doc_data.get("messages", [])
             states = doc_data.get("states", {s: "" for s in CONVERSATION_STATES})
             current_state = doc_data.get("current_state", "context")
+            summary = doc_data.get("summary", "")
         else:
             prompt_template = load_prompt("prompt_setgoal.txt")
             if not prompt_template:
@@ -2590,15 +3609,27 @@ def chat12_endpoint():
             history = [{"role": "system", "content": system_prompt}]
             states = {s: "" for s in CONVERSATION_STATES}
             current_state = "context"
+            summary = ""
+
+        # Messages older than the window are summarized in the background
+        # while the reply is generated, then dropped on save
+        overflow = history[1:-CHAT12_WINDOW + 1] if len(history) > CHAT12_WINDOW else []
+        summary_future = None
+        if len(overflow) >= CHAT12_SUMMARY_BATCH:
+            summary_future = IO_POOL.submit(_summarize_chat12, summary, overflow, user_client)
 
         # Append user message to history
         history.append({"role": "user", "content": user_message})
 
-        # Send only the conversation history to the AI (last role is user)
-        messages_for_model = history
+        # System prompt, summary of earlier turns, then the unsummarized messages (last role is user)
+        messages_for_model = history[:1]
+        if summary:
+            messages_for_model.append({"role": "system", "content": f"Summary of the conversation so far:\n{summary}"})
+        messages_for_model += history[1:]
 
         # Call the AI
-        response = client.chat.completions.create(
+        response = _call_llm(
+            llm_client=user_client,
             model="groq/compound",
             messages=messages_for_model,
             temperature=0.7,
@@ -2607,25 +3638,35 @@ def chat12_endpoint():
 
         ai_message = response.choices[0].message.content.strip()
 
-        # Save user's input as paragraph for current state
-        states[current_state] = ai_message
-
-        # Progress to next state if current input is sufficient
-        current_index = CONVERSATION_STATES.index(current_state)
-        if current_index < len(CONVERSATION_STATES) - 1:
-            next_state = CONVERSATION_STATES[current_index + 1]
-        else:
-            next_state = current_state  # final state remains
-
         # Append AI message to history
         history.append({"role": "assistant", "content": ai_message})
 
-        # Save to Firebase
-        doc_ref.set({
-            "messages": history,
-            "states": states,
-            "current_state": next_state
-        })
+        folded, new_summary = (), None
+        if summary_future is not None:
+            try:
+                new_summary = summary_future.result()
+                folded = overflow
+            except Exception as e:
+                print(f"chat12 summary failed: {e}")
+
+        # Save to Firebase. The state this reply answers and the next state
+        # come from the doc as stored at commit time.
+        current_state, conversation = _commit_chat12_turn(
+            db.transaction(),
+            doc_ref,
+            {
+                "messages": history[:-2],
+                "states": states,
+                "current_state": current_state,
+                "summary": summary
+            },
+            history[-2:],
+            ai_message,
+            folded,
+            new_summary
+        )
+        next_state = conversation["current_state"]
+        states = conversation["states"]
 
         return jsonify({
             "reply": ai_message,
@@ -2656,13 +3697,11 @@ def mindpal_reward_webhook():
         "rewards": rewards
     })
 
-    # ✅ Optionally also save to local file (if still needed)
-    local_data = read_rewards()
-    local_data[user_id] = {
+    # ✅ Also keep it as the user's current reward
+    reward_ref(user_id).set({
         "reward_list": rewards,
         "source": "mindpal"
-    }
-    write_rewards(local_data)
+    })
 
     return jsonify({"status": "Reward saved successfully"}), 200
 
@@ -2673,54 +3712,47 @@ def mindpal_reward_webhook():
 @app.route('/create-dated-course', methods=['POST'])
 def create_dated_course():
     data = request.get_json()
-    print("📥 Received payload:", data)  # Log incoming request
+    log.debug("create_dated_course payload keys=%s", list(data) if data else None)
 
     user_id = data.get("user_id")
     final_plan = data.get("final_plan")
     join_date_str = data.get("join_date")  # Optional: user join date
 
     if not user_id or not final_plan:
-        print("❌ Missing required data")
         return jsonify({"error": "Missing required data"}), 400
 
     # Parse join date
     try:
         joined_date = datetime.strptime(join_date_str, "%Y-%m-%d") if join_date_str else datetime.now()
-        print("📅 Parsed join date:", joined_date)
     except Exception as e:
-        print("⚠️ Failed to parse join date, using current date. Error:", e)
+        log.warning("Failed to parse join date %r, using current date: %s", join_date_str, e)
         joined_date = datetime.now()
 
-    # Convert final_plan into a dated plan
-    dated_plan = {}
-    for i, day_key in enumerate(final_plan.get("final_plan", {}), start=0):
-        date_str = (joined_date + timedelta(days=i)).strftime("%Y-%m-%d")
-        day_data = final_plan["final_plan"][day_key].copy()
-
-        # Convert tasks into toggle-ready objects
-        tasks_with_toggle = [{"task": t, "done": False} for t in day_data.get("tasks", [])]
-        day_data["tasks"] = tasks_with_toggle
-
-        dated_plan[date_str] = day_data
-
-    print("📝 Dated plan prepared:", dated_plan)
+    # Convert final_plan into a dated plan, with tasks as toggle-ready objects
+    days = final_plan.get("final_plan", {})
+    dated_plan = {
+        (joined_date + timedelta(days=i)).strftime("%Y-%m-%d"): {
+            **day_data,
+            "tasks": [{"task": t, "done": False} for t in day_data.get("tasks", [])]
+        }
+        for i, day_data in enumerate(days.values())
+    }
 
     # Save to Firebase
     try:
         course_id = "social_skills_101"  # You can make this dynamic
         doc_path = f"dated_courses/{user_id}/{course_id}"
-        print("📌 Writing to Firestore at:", doc_path)
 
         db.document(doc_path).set({
             "joined_date": joined_date.strftime("%Y-%m-%d"),
             "lessons_by_date": dated_plan
         })
 
-        print("✅ Write successful")
+        log.info("Saved dated course %s (%d days)", doc_path, len(dated_plan))
         return jsonify({"success": True, "dated_plan": dated_plan})
 
     except Exception as e:
-        print("❌ Failed to write to Firestore:", e)
+        log.exception("Failed to write dated course %s", doc_path)
         return jsonify({"error": f"Failed to save to Firebase: {str(e)}"}), 500
 
 
@@ -2735,35 +3767,39 @@ def toggle_task():
 
     if user_id is None or day is None or task_index is None or completed is None:
         return jsonify({"error": "Missing required fields"}), 400
+    # Firestore integers are signed 64-bit, so the mask holds up to 63 tasks
+    if not isinstance(task_index, int) or not 0 <= task_index < 63:
+        return jsonify({"error": "task_index must be an integer from 0 to 62"}), 400
 
     # Reference to user's task document for the day
     task_doc_ref = db.collection("users").document(user_id).collection("task_status").document(f"day_{day}")
     task_doc = task_doc_ref.get()
 
-    if task_doc.exists:
-        task_data = task_doc.to_dict()
-        tasks_completed = task_data.get("tasks_completed", [])
+    # Completion is stored as a bitmask (bit i = task i done) plus the
+    # number of task slots; docs written before that still hold a bool array
+    task_data = task_doc.to_dict() if task_doc.exists else {}
+    if "tasks_mask" in task_data:
+        mask = task_data["tasks_mask"]
+        total_tasks = task_data.get("total_tasks", 0)
     else:
-        # Initialize if not exists
-        tasks_completed = []
-
-    # Ensure the tasks_completed array has enough slots
-    while len(tasks_completed) <= task_index:
-        tasks_completed.append(False)
+        legacy = task_data.get("tasks_completed", [])
+        mask = sum(1 << i for i, done in enumerate(legacy) if done)
+        total_tasks = len(legacy)
 
     # Update the specific task's completion
-    tasks_completed[task_index] = completed
+    mask = (mask | (1 << task_index)) if completed else (mask & ~(1 << task_index))
+    total_tasks = max(total_tasks, task_index + 1)
 
     # Save back to Firestore
     task_doc_ref.set({
-        "tasks_completed": tasks_completed,
-        "timestamp": datetime.utcnow()
+        "tasks_mask": mask,
+        "total_tasks": total_tasks,
+        "timestamp": firestore.SERVER_TIMESTAMP
     })
 
     # Calculate daily progress
-    total_tasks = len(tasks_completed)
-    completed_count = sum(1 for t in tasks_completed if t)
-    daily_progress = completed_count / total_tasks if total_tasks > 0 else 0
+    daily_progress = mask.bit_count() / total_tasks
+    tasks_completed = [bool(mask >> i & 1) for i in range(total_tasks)]
 
     return jsonify({
         "day": day,
@@ -2773,51 +3809,143 @@ def toggle_task():
         "tasks_completed": tasks_completed
     })
 
-if __name__ == "__main__":
-    app.run(debug=True)
 
+# Endpoints that render one prompt from request fields, make one LLM call
+# and save the result under the user are generated from this table.
+class EndpointSpec(NamedTuple):
+    name: str                   # Flask endpoint name
+    route: str
+    prompt: str                 # Jinja prompt file
+    required: tuple             # request fields that must be non-empty
+    missing_error: str
+    render: Callable            # data -> prompt template values
+    save: str                   # save_to_firebase category
+    record: Callable            # (data, result) -> saved document
+    temperature: float = 0.4
+    max_tokens: int = 600
+    parse_json: bool = False    # parse the reply as JSON and return it as-is
+    result_key: str = "response"  # otherwise return {result_key: text}
+    valid: Callable = lambda data: True
+    # Error bodies, kept as each endpoint returned them before the table:
+    parse_error: Optional[str] = "Failed to parse JSON"  # None: report like any other error
+    raw_key: str = "raw_response"  # key for the unparsed reply
+    error_prefix: str = "AI error: "
+
+
+ENDPOINT_SPECS = (
+    EndpointSpec(
+        name="support_room_question",
+        route="/support-room-question",
+        prompt="prompt_support_room.txt",
+        required=("task", "question"),
+        missing_error="Missing task or question",
+        render=lambda data: {"task": data["task"].strip(), "question": data["question"].strip()},
+        save="support_room_responses",
+        record=lambda data, result: {
+            "task": data["task"].strip(),
+            "question": data["question"].strip(),
+            "response": result
+        },
+        error_prefix="",
+    ),
+    EndpointSpec(
+        name="generate_action_level_questions",
+        route="/generate-action-level-questions",
+        prompt="prompt_action_level_questions.txt",
+        required=(),
+        missing_error="",
+        render=lambda data: {},
+        save="action_level_questions",
+        record=lambda data, parsed: {"questions": parsed.get("questions", [])},
+        max_tokens=400,
+        parse_json=True,
+        parse_error="Failed to parse questions JSON",
+        raw_key="raw",
+    ),
+    EndpointSpec(
+        name="rescue_plan_chat_start",
+        route="/rescue-plan-chat-start",
+        prompt="prompt_rescue_chat_questions.txt",
+        required=("task",),
+        missing_error="Missing task",
+        render=lambda data: {"task": data["task"]},
+        save="rescue_chat_questions",
+        record=lambda data, parsed: {"task": data["task"], "questions": parsed.get("questions", [])},
+        max_tokens=300,
+        parse_json=True,
+        parse_error=None,
+        error_prefix="",
+    ),
+    EndpointSpec(
+        name="analyze_action_level",
+        route="/analyze-action-level",
+        prompt="prompt_analyze_action_level.txt",
+        required=("user_id", "answers"),
+        missing_error="Missing or invalid user_id or answers",
+        render=lambda data: {
+            "userlevelanswers": "\n".join(f"{i+1}. {ans}" for i, ans in enumerate(data["answers"]))
+        },
+        save="action_level_analysis",
+        record=lambda data, parsed: {"answers": data["answers"], "analysis": parsed},
+        parse_json=True,
+        valid=lambda data: isinstance(data["answers"], list),
+    ),
+    EndpointSpec(
+        name="achievement_summary",
+        route="/achievement-summary",
+        prompt="prompt_achievement_summary.txt",
+        required=("user_id", "plan"),
+        missing_error="Missing user_id or plan",
+        render=lambda data: {"plan": orjson.dumps(data["plan"], option=orjson.OPT_INDENT_2).decode()},
+        save="achievement_summaries",
+        record=lambda data, result: {"plan": data["plan"], "achievement_summary": result},
+        temperature=0.5,
+        result_key="achievement_summary",
+        error_prefix="",
+    ),
+)
 
-@app.route('/support-room-question', methods=['POST'])
-def support_room_question():
-    data = request.get_json()
-    user_id = data.get("user_id")
-    task = data.get("task", "").strip()
-    question = data.get("question", "").strip()
 
-    if not task or not question:
-        return jsonify({"error": "Missing task or question"}), 400
+def _make_llm_endpoint(spec):
+    """Build the view function for one EndpointSpec."""
+    def handler():
+        data = request.get_json() or {}
+        if any(not data.get(field) for field in spec.required) or not spec.valid(data):
+            return jsonify({"error": spec.missing_error}), 400
 
-    prompt_template = load_prompt("prompt_support_room.txt")
-    if not prompt_template:
-        return jsonify({"error": "prompt_support_room.txt not found"}), 500
+        prompt = render_prompt(spec.prompt, **spec.render(data))
+        if not prompt:
+            return jsonify({"error": f"{spec.prompt} not found"}), 500
 
-    prompt = (
-        prompt_template
-        .replace("<<task>>", task)
-        .replace("<<question>>", question)
-    )
+        try:
+            response = _call_llm(
+                model="meta-llama/llama-4-scout-17b-16e-instruct",
+                messages=[{"role": "user", "content": prompt}],
+                temperature=spec.temperature,
+                max_tokens=spec.max_tokens
+            )
+            result = response.choices[0].message.content.strip()
 
-    try:
-        response = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.4,
-            max_tokens=600
-        )
-        result = response.choices[0].message.content.strip()
+            if spec.parse_json:
+                try:
+                    result = orjson.loads(_strip_code_fence(result))
+                except orjson.JSONDecodeError:
+                    if spec.parse_error is None:
+                        raise
+                    return jsonify({"error": spec.parse_error, spec.raw_key: result}), 500
 
-        # Optionally: save in Firestore
-        save_to_firebase(user_id, "support_room_responses", {
-            "task": task,
-            "question": question,
-            "response": result
-        })
+            save_to_firebase(data.get("user_id"), spec.save, spec.record(data, result))
+            return jsonify(result if spec.parse_json else {spec.result_key: result})
+
+        except Exception as e:
+            return jsonify({"error": f"{spec.error_prefix}{str(e)}"}), 500
 
-        return jsonify({"response": result})
+    handler.__name__ = spec.name
+    return handler
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
 
+for _spec in ENDPOINT_SPECS:
+    app.add_url_rule(_spec.route, endpoint=_spec.name, view_func=_make_llm_endpoint(_spec), methods=["POST"])
 
 
 @app.route('/rescue-plan-chat-answers', methods=['POST'])
@@ -2845,74 +3973,6 @@ def rescue_plan_chat_answers():
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/generate-action-level-questions', methods=['POST'])
-def generate_action_level_questions():
-    data = request.get_json()
-    user_id = data.get("user_id", "")
-
-    prompt_template = load_prompt("prompt_action_level_questions.txt")
-    if not prompt_template:
-        return jsonify({"error": "prompt_action_level_questions.txt not found"}), 500
-
-    try:
-        response = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[{"role": "user", "content": prompt_template}],
-            temperature=0.4,
-            max_tokens=400
-        )
-        result = response.choices[0].message.content.strip()
-
-        try:
-            parsed = json.loads(result)
-        except json.JSONDecodeError:
-            return jsonify({"error": "Failed to parse questions JSON", "raw": result}), 500
-
-        save_to_firebase(user_id, "action_level_questions", {
-            "questions": parsed.get("questions", [])
-        })
-
-        return jsonify(parsed)
-
-    except Exception as e:
-        return jsonify({"error": f"AI error: {str(e)}"}), 500
-
-
-@app.route('/rescue-plan-chat-start', methods=['POST'])
-def rescue_plan_chat_start():
-    data = request.get_json()
-    task = data.get("task", "")
-    user_id = data.get("user_id", "")
-
-    if not task:
-        return jsonify({"error": "Missing task"}), 400
-
-    prompt_template = load_prompt("prompt_rescue_chat_questions.txt")
-    if not prompt_template:
-        return jsonify({"error": "prompt_rescue_chat_questions.txt not found"}), 500
-
-    prompt = prompt_template.replace("<<task>>", task)
-
-    try:
-        response = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.4,
-            max_tokens=300
-        )
-        result = response.choices[0].message.content.strip()
-        parsed = json.loads(result)
-
-        save_to_firebase(user_id, "rescue_chat_questions", {
-            "task": task,
-            "questions": parsed.get("questions", [])
-        })
-
-        return jsonify(parsed)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-
 @app.route('/generate-rescue-kit', methods=['POST', 'OPTIONS'])
 @cross_origin()
 def generate_rescue_kit():
@@ -2932,121 +3992,37 @@ def generate_rescue_kit():
 
         risks_formatted = "\n".join([f"- {r}" for r in risks])
 
-        prompt_template = load_prompt("prompt_rescue_kit.txt")
-        if not prompt_template:
+        prompt = render_prompt("prompt_rescue_kit.txt", task=task, risks=risks_formatted, reward=reward)
+        if not prompt:
             return jsonify({"error": "prompt_rescue_kit.txt not found"}), 500
 
-        prompt = (
-            prompt_template
-            .replace("<<task>>", task)
-            .replace("<<risks>>", risks_formatted)
-            .replace("<<reward>>", reward)
-        )
-
-        response = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.4,
-            max_tokens=700
-        )
-        result = response.choices[0].message.content.strip()
-
-        parsed = json.loads(result)
-
-        save_to_firebase(user_id, "rescue_kit", {
-            "task": task,
-            "risks": risks,
-            "reward": reward,
-            "rescue_plans": parsed.get("plans", [])
-        })
-
-        return jsonify(parsed)
-    
-    except Exception as e:
-        print("❌ Backend error:", str(e))
-        return jsonify({"error": str(e)}), 500
-
-@app.route('/analyze-action-level', methods=['POST'])
-def analyze_action_level():
-    data = request.get_json()
-    user_id = data.get("user_id")
-    answers = data.get("answers", [])
-
-    if not user_id or not isinstance(answers, list) or not answers:
-        return jsonify({"error": "Missing or invalid user_id or answers"}), 400
-
-    formatted_answers = "\n".join([f"{i+1}. {ans}" for i, ans in enumerate(answers)])
+        def on_complete(text):
+            parsed = orjson.loads(_strip_code_fence(text))
 
-    prompt_template = load_prompt("prompt_analyze_action_level.txt")
-    if not prompt_template:
-        return jsonify({"error": "prompt_analyze_action_level.txt not found"}), 500
-
-    prompt = prompt_template.replace("<<userlevelanswers>>", formatted_answers)
-
-    try:
-        response = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.4,
-            max_tokens=600
-        )
-        result = response.choices[0].message.content.strip()
-
-        try:
-            parsed = json.loads(result)
-        except json.JSONDecodeError:
-            return jsonify({"error": "Failed to parse JSON", "raw_response": result}), 500
-
-        # Store result in Firebase
-        save_to_firebase(user_id, "action_level_analysis", {
-            "answers": answers,
-            "analysis": parsed
-        })
-
-        return jsonify(parsed)
-
-    except Exception as e:
-        return jsonify({"error": f"AI error: {str(e)}"}), 500
-
-
-@app.route('/achievement-summary', methods=['POST'])
-def achievement_summary():
-    data = request.get_json()
-    user_id = data.get("user_id")
-    plan = data.get("plan")  # The user's plan input (likely a dict)
-
-    if not user_id or not plan:
-        return jsonify({"error": "Missing user_id or plan"}), 400
-
-    prompt_template = load_prompt("prompt_achievement_summary.txt")
-    if not prompt_template:
-        return jsonify({"error": "prompt_achievement_summary.txt not found"}), 500
-
-    # Inject the plan JSON into your prompt template
-    prompt = prompt_template.replace("<<plan>>", json.dumps(plan, indent=2))
+            save_to_firebase(user_id, "rescue_kit", {
+                "task": task,
+                "risks": risks,
+                "reward": reward,
+                "rescue_plans": parsed.get("plans", [])
+            })
+            return parsed
 
-    try:
-        response = client.chat.completions.create(
+        response = _call_llm(
             model="meta-llama/llama-4-scout-17b-16e-instruct",
             messages=[{"role": "user", "content": prompt}],
-            temperature=0.5,
-            max_tokens=600
+            temperature=0.4,
+            max_tokens=700,
+            stream=bool(data.get("stream"))
         )
-        achievement_text = response.choices[0].message.content.strip()
-
-        # Optionally save achievement summary to Firebase
-        save_to_firebase(user_id, "achievement_summaries", {
-            "plan": plan,
-            "achievement_summary": achievement_text
-        })
-
-        return jsonify({"achievement_summary": achievement_text})
+        if data.get("stream"):
+            return _sse_response(response, on_complete)
 
+        return jsonify(on_complete(response.choices[0].message.content))
+    
     except Exception as e:
+        print("❌ Backend error:", str(e))
         return jsonify({"error": str(e)}), 500
 
-
-
 @app.route('/start-day-chat', methods=['POST', 'OPTIONS'])
 def start_day_chat():
     if request.method == 'OPTIONS':
@@ -3060,34 +4036,36 @@ def start_day_chat():
     if not user_id or not day_number or not isinstance(sections, list):
         return jsonify({"error": "Invalid input"}), 400
 
-    prompt_template = load_prompt("prompt_customize_day.txt")
-    if not prompt_template:
+    formatted_sections = "\n".join([f"- {s}" for s in sections])
+    prompt = render_prompt("prompt_customize_day.txt", day_number=day_number, subsections=formatted_sections)
+    if not prompt:
         return jsonify({"error": "prompt_customize_day.txt not found"}), 500
 
-    formatted_sections = "\n".join([f"- {s}" for s in sections])
-    prompt = (
-        prompt_template
-        .replace("<<day_number>>", str(day_number))
-        .replace("<<subsections>>", formatted_sections)
-    )
+    def on_complete(text):
+        msg = text.strip()
+
+        # New chat plus the user doc's latest_chat_id pointer, so replies
+        # can fetch it directly instead of querying for the newest day
+        user_ref = db.collection("users").document(user_id)
+        chat_ref = user_ref.collection("custom_day_chat").document()
+        batch = db.batch()
+        batch.set(chat_ref, {"day": day_number, "sections": sections})
+        append_chat_messages(batch, chat_ref, [{"role": "assistant", "content": msg}], 0, "chat")
+        batch.set(user_ref, {"latest_chat_id": chat_ref.id}, merge=True)
+        batch.commit()
+        return {"message": msg}
 
     try:
-        response = client.chat.completions.create(
+        response = _call_llm(
             model="meta-llama/llama-4-scout-17b-16e-instruct",
             messages=[{"role": "system", "content": prompt}],
             temperature=0.5,
-            max_tokens=300
+            max_tokens=300,
+            stream=bool(data.get("stream"))
         )
-        msg = response.choices[0].message.content.strip()
-
-        chat_data = {
-            "day": day_number,
-            "sections": sections,
-            "chat": [{"role": "assistant", "content": msg}]
-        }
-
-        save_to_firebase(user_id, "custom_day_chat", chat_data)
-        return jsonify({"message": msg})
+        if data.get("stream"):
+            return _sse_response(response, on_complete)
+        return jsonify(on_complete(response.choices[0].message.content))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -3105,29 +4083,40 @@ def reply_day_chat():
     if not user_id or not message:
         return jsonify({"error": "Missing input"}), 400
 
-    chats = db.collection("users").document(user_id).collection("custom_day_chat")
-    docs = list(chats.order_by("day", direction=firestore.Query.DESCENDING).limit(1).stream())
-    if not docs:
+    user_ref = db.collection("users").document(user_id)
+    user_doc = user_ref.get()
+    latest_chat = get_latest_day_chat(
+        user_ref.collection("custom_day_chat"),
+        user_doc.to_dict() if user_doc.exists else None
+    )
+    if latest_chat is None:
         return jsonify({"error": "Chat not started"}), 404
 
-    doc_ref = docs[0].reference
-    chat_data = docs[0].to_dict()
-    chat_history = chat_data.get("chat", [])
+    doc_ref = latest_chat.reference
+    chat_history, persisted_count = load_chat_messages(doc_ref, latest_chat.to_dict(), "chat")
 
     chat_history.append({"role": "user", "content": message})
 
+    def on_complete(text):
+        reply = text.strip()
+        chat_history.append({"role": "assistant", "content": reply})
+
+        batch = db.batch()
+        append_chat_messages(batch, doc_ref, chat_history, persisted_count, "chat")
+        batch.commit()
+        return {"reply": reply}
+
     try:
-        response = client.chat.completions.create(
+        response = _call_llm(
             model="meta-llama/llama-4-scout-17b-16e-instruct",
             messages=chat_history,
             temperature=0.5,
-            max_tokens=500
+            max_tokens=500,
+            stream=bool(data.get("stream"))
         )
-        reply = response.choices[0].message.content.strip()
-        chat_history.append({"role": "assistant", "content": reply})
-
-        doc_ref.update({"chat": chat_history})
-        return jsonify({"reply": reply})
+        if data.get("stream"):
+            return _sse_response(response, on_complete)
+        return jsonify(on_complete(response.choices[0].message.content))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -3159,8 +4148,8 @@ def mentor_chat():
         if not api_key:
             return jsonify({"error": "Missing API key in Authorization header"}), 401
         
-        # Initialize client with provided API key
-        client.api_key = api_key
+        # Bind the user's API key to this request only
+        user_client = _client_for(api_key)
         
         # Generate conversation_id if not provided
         if not conversation_id:
@@ -3184,7 +4173,8 @@ def mentor_chat():
         history.append({"role": "user", "content": user_message})
         
         # Call the AI model
-        response = client.chat.completions.create(
+        response = _call_llm(
+            llm_client=user_client,
             model="meta-llama/llama-4-scout-17b-16e-instruct",
             messages=history,
             temperature=0.7,
@@ -3280,49 +4270,45 @@ def finalize_day_chat():
     if not user_id or not user_data or not ogplan:
         return jsonify({"error": "Missing required data"}), 400
 
-    chats = db.collection("users").document(user_id).collection("custom_day_chat")
-    docs = list(chats.order_by("day", direction=firestore.Query.DESCENDING).limit(1).stream())
-    if not docs:
+    user_ref = db.collection("users").document(user_id)
+    user_doc = user_ref.get()
+    latest_chat = get_latest_day_chat(
+        user_ref.collection("custom_day_chat"),
+        user_doc.to_dict() if user_doc.exists else None
+    )
+    if latest_chat is None:
         return jsonify({"error": "No chat session found"}), 404
 
-    chat = docs[0].to_dict()
-    chat_history = chat.get("chat", [])
+    chat = latest_chat.to_dict()
+    chat_history, _ = load_chat_messages(latest_chat.reference, chat, "chat")
     day_number = chat.get("day")
 
-    finalize_prompt = load_prompt("prompt_customize_day_finalize.txt")
-    if not finalize_prompt:
-        return jsonify({"error": "prompt_customize_day_finalize.txt not found"}), 500
-
-    final_instruction = (
-        finalize_prompt
-        .replace("<<user_data>>", json.dumps(user_data, indent=2))
-        .replace("<<ogplan>>", json.dumps(ogplan, indent=2))
-        .replace("<<day_number>>", str(day_number))
+    final_instruction = render_prompt(
+        "prompt_customize_day_finalize.txt",
+        user_data=orjson.dumps(user_data, option=orjson.OPT_INDENT_2).decode(),
+        ogplan=orjson.dumps(ogplan, option=orjson.OPT_INDENT_2).decode(),
+        day_number=day_number,
     )
+    if not final_instruction:
+        return jsonify({"error": "prompt_customize_day_finalize.txt not found"}), 500
 
     chat_history.append({"role": "user", "content": final_instruction})
 
-    try:
-        response = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=chat_history,
-            temperature=0.4,
-            max_tokens=4000
-        )
-        final_output = response.choices[0].message.content.strip()
+    def on_complete(text):
+        final_output = text.strip()
 
         # Remove ```json or ``` wrapping from the AI response
-        cleaned_output = re.sub(r"^```(?:json)?|```$", "", final_output.strip(), flags=re.MULTILINE).strip()
+        cleaned_output = _strip_code_fence(final_output)
 
         try:
-            parsed = json.loads(cleaned_output)
-        except json.JSONDecodeError as json_err:
-            return jsonify({
+            parsed = orjson.loads(cleaned_output)
+        except orjson.JSONDecodeError as json_err:
+            return {
                 "error": "Failed to parse final JSON",
                 "raw": final_output,
                 "cleaned": cleaned_output,
                 "details": str(json_err)
-            }), 500
+            }
 
         final_data = {
             "day": day_number,
@@ -3330,7 +4316,21 @@ def finalize_day_chat():
         }
 
         save_to_firebase(user_id, "custom_day_final_plans", final_data)
-        return jsonify({"final_plan": parsed})
+        return {"final_plan": parsed}
+
+    try:
+        response = _call_llm(
+            model="meta-llama/llama-4-scout-17b-16e-instruct",
+            messages=chat_history,
+            temperature=0.4,
+            max_tokens=4000,
+            stream=bool(data.get("stream"))
+        )
+        if data.get("stream"):
+            return _sse_response(response, on_complete)
+
+        result = on_complete(response.choices[0].message.content)
+        return jsonify(result), (500 if "error" in result else 200)
     
     except Exception as e:
         return jsonify({"error": f"Backend error: {str(e)}"}), 500
@@ -3371,7 +4371,7 @@ def ask_questions():
     prompt = prompt_template.format(goal_name=goal_name)
 
     try:
-        response = client.chat.completions.create(
+        response = _call_llm(
             model="groq/compound",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.3,
@@ -3390,249 +4390,461 @@ def ask_questions():
 
 # ============ HELPER FUNCTIONS ============
 
-def load_prompt(filename):
-    """Load prompt template from file"""
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        return None
-
 def get_course_ref(user_id, course_id):
     """Get reference to the course document"""
     return db.collection('users').document(user_id).collection('datedcourses').document(course_id)
 
-def determine_difficulty(task_text):
-    """Determine task difficulty based on keywords"""
-    lower_task = task_text.lower()
-    if any(word in lower_task for word in ['review', 'reflect', 'schedule', 'take a few minutes', 'read']):
-        return 'easy'
-    elif any(word in lower_task for word in ['practice', 'connect', 'reach out', 'write', 'try']):
-        return 'medium'
-    else:
-        return 'hard'
+# ============ DAY PLAN GENERATION ============
+class DayPlanError(Exception):
+    """A day plan couldn't be generated; payload and status go back to the client."""
+    def __init__(self, payload, status=500):
+        super().__init__(payload.get("error"))
+        self.payload = payload
+        self.status = status
 
-# ============ MAIN ENDPOINT CREATOR ============
-# ============ MAIN ENDPOINT CREATOR (FIXED) ============
-def create_day_endpoint(day):
-    endpoint_name = f"final_plan_day_{day}"
-    route_path = f"/final-plan-day{day}"
-    
-    @app.route(route_path, methods=['POST'], endpoint=endpoint_name)
-    def final_plan_day_func():
-        # ========== STEP 1: Parse Request ==========
-        data = request.get_json()
-        if not data:
-            return jsonify({"error": "Invalid JSON payload"}), 400
 
-        goal_name = data.get("goal_name", "").strip()
-        user_answers = data.get("user_answers", [])
-        user_id = data.get("user_id", "").strip()
-        join_date_str = data.get("join_date")
-        
-        if not goal_name or not isinstance(user_answers, list) or not user_id:
-            return jsonify({"error": "Missing or invalid goal_name, user_answers, or user_id"}), 400
+def _day_plan_prompt_template(day):
+    prompt_file = f"prompt_plan_{day:02}.txt"
+    prompt_template = load_prompt(prompt_file)
+    if not prompt_template:
+        raise DayPlanError({"error": f"{prompt_file} not found"}, 404)
+    return prompt_template
 
-        try:
-            joined_date = datetime.strptime(join_date_str, "%Y-%m-%d") if join_date_str else datetime.now()
-        except:
-            joined_date = datetime.now()
-        
-        day_date = (joined_date + timedelta(days=day-1)).strftime("%Y-%m-%d")
-        course_id = goal_name.lower().replace(" ", "_")
 
-        # Escape user inputs to avoid breaking JSON
-        safe_goal_name = json.dumps(goal_name)[1:-1]  # strip surrounding quotes
-        safe_user_answers = json.dumps(user_answers)
-        
-        formatted_answers = "\n".join(
-            [f"{i+1}. {answer.strip()}" for i, answer in enumerate(user_answers) if isinstance(answer, str)]
+@lru_cache(maxsize=4096)
+def _course_id(goal_name):
+    return goal_name.lower().replace(" ", "_")
+
+
+@lru_cache(maxsize=4096)
+def _json_escaped(text):
+    """text escaped for use inside a JSON string literal, without the quotes."""
+    return orjson.dumps(text).decode()[1:-1]
+
+
+def needs_previous_day(day):
+    """True if day's prompt embeds the previous day's lesson."""
+    try:
+        return day > 1 and f"<<day_{day-1}_json>>" in _day_plan_prompt_template(day)
+    except DayPlanError:
+        return False
+
+
+def _lesson_json(lesson):
+    return orjson.dumps(lesson).decode()
+
+
+def _day_plan_prompt(day, goal_name, user_answers, previous_day_json=None):
+    """
+    Fill in the day's prompt template. previous_day_json is the previous
+    day's lesson already serialized.
+    """
+    # Escape user inputs to avoid breaking JSON
+    safe_goal_name = _json_escaped(goal_name)
+    safe_user_answers = orjson.dumps(user_answers).decode()
+
+    # Insert safely escaped user inputs
+    prompt = _day_plan_prompt_template(day)
+    prompt = prompt.replace("<<goal_name>>", safe_goal_name)
+    prompt = prompt.replace("<<user_answers>>", safe_user_answers)
+    if previous_day_json:
+        prompt = prompt.replace(f"<<day_{day-1}_json>>", previous_day_json)
+    return prompt
+
+
+_DAY_PLAN_SYSTEM_MESSAGE = {"role": "system", "content": "Respond only with JSON."}
+
+
+def build_day_lesson(day, goal_name, user_answers, day_date, llm_client, previous_day_json=None):
+    """
+    Generate one day's lesson and shape it into the app's lesson structure.
+    Doesn't touch Firestore. Raises DayPlanError on failure.
+    """
+    prompt = _day_plan_prompt(day, goal_name, user_answers, previous_day_json)
+
+    # ========== Generate AI Plan ==========
+    # JSON mode, so the reply is the object itself with no prose to strip
+    try:
+        result = cached_complete(
+            "groq/compound",
+            [_DAY_PLAN_SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
+            temperature=0.4,
+            max_tokens=4096,
+            llm_client=llm_client,
+            response_format={"type": "json_object"},
+            cache=False
         )
-        
-        api_key = request.headers.get("Authorization", "").replace("Bearer ", "").strip()
-        if not api_key:
-            return jsonify({"error": "Missing API key in Authorization header"}), 401
-        client.api_key = api_key
+    except Exception as e:
+        raise DayPlanError({"error": "API request failed", "exception": str(e)})
 
-        # ========== STEP 2: Load Previous Day ==========
-        previous_day_lesson = None
-        if day > 1:
-            try:
-                course_ref = get_course_ref(user_id, course_id)
-                course_doc = course_ref.get()
-                if course_doc.exists:
-                    course_data = course_doc.to_dict()
-                    lessons_by_date = course_data.get('lessons_by_date', {})
-                    prev_day_date = (joined_date + timedelta(days=day-2)).strftime("%Y-%m-%d")
-                    previous_day_lesson = lessons_by_date.get(prev_day_date)
-                    print(f"✅ Loaded previous day ({prev_day_date}) for context")
-            except Exception as e:
-                print(f"⚠️ Could not load previous day: {e}")
-                previous_day_lesson = None
-
-        # ========== STEP 3: Load Prompt Template ==========
-        prompt_file = f"prompt_plan_{day:02}.txt"
-        prompt_template = load_prompt(prompt_file)
-        if not prompt_template:
-            return jsonify({"error": f"{prompt_file} not found"}), 404
-
-        # Insert safely escaped user inputs
-        prompt = prompt_template.replace("<<goal_name>>", safe_goal_name)
-        prompt = prompt.replace("<<user_answers>>", safe_user_answers)
-        if previous_day_lesson:
-            placeholder = f"<<day_{day-1}_json>>"
-            if placeholder in prompt:
-                prompt = prompt.replace(placeholder, json.dumps(previous_day_lesson))
-
-        # ========== STEP 4: Generate AI Plan ==========
+    try:
+        parsed_day_plan = orjson.loads(result)
+    except orjson.JSONDecodeError:
+        parsed_day_plan = None
+    if not isinstance(parsed_day_plan, dict) or not parsed_day_plan:
+        raise DayPlanError({"error": f"Failed to parse Day {day} as valid JSON", "raw_response": result})
+    print(f"✅ Day {day} plan generated from AI")
+    return shape_day_lesson(parsed_day_plan, day_date)
+
+
+# (lesson key, model output keys to accept for it, factory for the default)
+_DAY_PLAN_KEYS = (
+    ("title", ("title", "day_title", "name"), str),
+    ("summary", ("summary", "overview", "description"), str),
+    ("lesson", ("lesson", "content", "instructions"), str),
+    ("motivation", ("motivation", "inspiration", "encouragement"), str),
+    ("why", ("why", "purpose", "importance"), str),
+    ("book_quote", ("book_quote", "citation"), str),
+    ("secret_hacks_and_shortcuts", ("secret_hacks_and_shortcuts", "tips", "hacks"), str),
+    ("self_coaching_questions", ("self_coaching_questions", "questions", "prompts"), list),
+    ("tiny_daily_rituals_that_transform", ("tiny_daily_rituals_that_transform", "rituals", "micro_habits"), str),
+    ("visual_infographic_html", ("visual_infographic_html", "infographic", "html"), str),
+    ("task", ("task", "tasks", "actions"), list),
+)
+
+
+def shape_day_lesson(parsed_day_plan, day_date):
+    """Map the model's day plan JSON onto the app's lesson structure."""
+    lesson_data = {}
+    for key, alternatives, default in _DAY_PLAN_KEYS:
+        value = next((parsed_day_plan[alt] for alt in alternatives if alt in parsed_day_plan), None)
+        lesson_data[key] = default() if value is None else value
+
+    # Normalize tasks: exactly 3, padded with empty descriptions
+    raw_tasks = lesson_data.get("task", [])
+    if isinstance(raw_tasks, list):
+        raw_tasks = raw_tasks[:3]
+        raw_tasks += [""] * (3 - len(raw_tasks))
+        lesson_data["task"] = [
+            {
+                "task_number": i+1,
+                "description": task if isinstance(task, str) else task.get("description", "")
+            }
+            for i, task in enumerate(raw_tasks)
+        ]
+    else:
+        lesson_data["task"] = []
+
+    # Add date and completion info
+    lesson_data["date"] = day_date
+    lesson_data["completed"] = False
+    lesson_data["reflection"] = ""
+    return lesson_data
+
+
+class DayPlanRequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    goal_name: str = Field(min_length=1)
+    user_answers: List[Any] = Field(default_factory=list)
+    user_id: str = Field(min_length=1)
+    join_date: Optional[str] = None
+    stream: bool = False
+
+
+def _parse_day_plan_request():
+    """
+    Turn the validated day plan request (g.req) into the inputs the builders
+    need. Returns (inputs, None) or (None, error response).
+    """
+    req = g.req
+    try:
+        joined_date = datetime.strptime(req.join_date, "%Y-%m-%d").date() if req.join_date else date.today()
+    except ValueError:
+        joined_date = date.today()
+
+    api_key = request.headers.get("Authorization", "").replace("Bearer ", "").strip()
+    if not api_key:
+        return None, (jsonify({"error": "Missing API key in Authorization header"}), 401)
+
+    return {
+        "goal_name": req.goal_name,
+        "user_answers": req.user_answers,
+        "user_id": req.user_id,
+        "joined_date": joined_date,
+        "course_id": _course_id(req.goal_name),
+        "user_client": _client_for(api_key)
+    }, None
+
+
+def _save_day_lessons(user_id, course_id, goal_name, joined_date, lessons):
+    """
+    Write {date: lesson} into the course's lessons_by_date in one write,
+    touching only those dates' fields. Creates the course doc if it is missing.
+    """
+    course_ref = get_course_ref(user_id, course_id)
+    try:
+        course_ref.update({
+            FieldPath('lessons_by_date', day_date).to_api_repr(): lesson
+            for day_date, lesson in lessons.items()
+        })
+    except NotFound:
+        # merge so a day saved concurrently by another request isn't dropped
+        course_ref.set({
+            'joined_date': joined_date.isoformat(),
+            'goal_name': goal_name,
+            'lessons_by_date': lessons,
+            'created_at': datetime.now().isoformat()
+        }, merge=True)
+
+
+# ============ DAY PLAN ENDPOINTS ============
+def _load_previous_day_json(user_id, course_id, prev_day_date):
+    """
+    Read one lesson from a course with a field mask, so only that entry of
+    lessons_by_date comes back instead of every lesson so far, and return it
+    serialized.
+    """
+    field = FieldPath("lessons_by_date", prev_day_date)
+    course_doc = get_course_ref(user_id, course_id).get(field_paths=[field.to_api_repr()])
+    if not course_doc.exists:
+        return None
+    lesson = course_doc.to_dict().get("lessons_by_date", {}).get(prev_day_date)
+    if lesson is None:
+        return None
+    return _lesson_json(lesson)
+
+
+DAY_PLAN_DAYS = range(1, 6)
+
+
+@app.route('/create-day/<int:day>', methods=['POST'])
+def create_day(day):
+    if day not in DAY_PLAN_DAYS:
+        return jsonify({"error": f"Invalid day {day}; expected 1-{DAY_PLAN_DAYS[-1]}"}), 400
+
+    # ========== STEP 1: Parse Request ==========
+    inputs, error = _parse_day_plan_request()
+    if error:
+        return error
+    user_id = inputs["user_id"]
+    course_id = inputs["course_id"]
+    joined_date = inputs["joined_date"]
+    day_date = (joined_date + timedelta(days=day-1)).isoformat()
+
+    # ========== STEP 2: Load Previous Day ==========
+    # Only days whose prompt embeds the previous lesson pay for the read
+    previous_day_json = None
+    if needs_previous_day(day):
         try:
-            response = client.chat.completions.create(
-                model="groq/compound",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.4,
-                max_tokens=4096
-            )
-            result = response.choices[0].message.content.strip()
+            prev_day_date = (joined_date + timedelta(days=day-2)).isoformat()
+            previous_day_json = _load_previous_day_json(user_id, course_id, prev_day_date)
+            if previous_day_json is not None:
+                print(f"✅ Loaded previous day ({prev_day_date}) for context")
         except Exception as e:
-            return jsonify({"error": "API request failed", "exception": str(e)}), 500
+            print(f"⚠️ Could not load previous day: {e}")
+            previous_day_json = None
 
-        # Robust JSON extraction
-        import re
-        def extract_json(text: str):
-            match = re.search(r'(\{.*\})', text, re.DOTALL)
-            if match:
-                try:
-                    return json.loads(match.group(1))
-                except json.JSONDecodeError:
-                    return None
-            return None
+    if g.req.stream:
+        return _stream_day_lesson(day, inputs, day_date, previous_day_json)
 
-        parsed_day_plan = extract_json(result)
-        if not parsed_day_plan:
-            return jsonify({"error": f"Failed to parse Day {day} as valid JSON", "raw_response": result}), 500
-        print(f"✅ Day {day} plan generated from AI")
-
-        # ========== STEP 5: Transform to App Structure ==========
-        expected_keys = {
-            "title": ["title", "day_title", "name"],
-            "summary": ["summary", "overview", "description"],
-            "lesson": ["lesson", "content", "instructions"],
-            "motivation": ["motivation", "inspiration", "encouragement"],
-            "why": ["why", "purpose", "importance"],
-            "book_quote": ["book_quote", "citation"],
-            "secret_hacks_and_shortcuts": ["secret_hacks_and_shortcuts", "tips", "hacks"],
-            "self_coaching_questions": ["self_coaching_questions", "questions", "prompts"],
-            "tiny_daily_rituals_that_transform": ["tiny_daily_rituals_that_transform", "rituals", "micro_habits"],
-            "visual_infographic_html": ["visual_infographic_html", "infographic", "html"],
-            "task": ["task", "tasks", "actions"]
-        }
+    # ========== STEP 3-5: Generate and Shape the Lesson ==========
+    try:
+        lesson_data = build_day_lesson(
+            day, inputs["goal_name"], inputs["user_answers"], day_date,
+            inputs["user_client"], previous_day_json
+        )
+    except DayPlanError as e:
+        return jsonify(e.payload), e.status
+
+    # ========== STEP 6: Save to Firebase ==========
+    try:
+        _save_day_lessons(user_id, course_id, inputs["goal_name"], joined_date, {day_date: lesson_data})
+        print(f"✅ Saved Day {day} to Firebase")
+    except Exception as e:
+        return jsonify({"error": f"Failed to save to Firebase: {str(e)}"}), 500
+
+    # ========== STEP 7: Return Response ==========
+    return jsonify({
+        "success": True,
+        "day": day,
+        "date": day_date,
+        "course_id": course_id,
+        "lesson": lesson_data,
+        "message": f"Day {day} lesson created successfully"
+    })
+
+
+REQUEST_MODELS["create_day"] = DayPlanRequest
+
+# The original per-day URLs, kept as aliases of /create-day/<day>
+for i in DAY_PLAN_DAYS:
+    app.add_url_rule(f"/final-plan-day{i}", endpoint=f"final_plan_day_{i}", view_func=create_day,
+                     methods=['POST'], defaults={"day": i})
+    REQUEST_MODELS[f"final_plan_day_{i}"] = DayPlanRequest
+
+
+def _ndjson_line(data):
+    return orjson.dumps(data) + b"\n"
 
-        lesson_data = {}
-        for key, alternatives in expected_keys.items():
-            value = None
-            for alt in alternatives:
-                if alt in parsed_day_plan:
-                    value = parsed_day_plan[alt]
-                    break
-            # sensible defaults
-            if value is None:
-                if key == "task":
-                    value = []
-                elif key == "self_coaching_questions":
-                    value = []
-                elif key == "book_quote" or key == "motivation" or key == "summary" or key == "title":
-                    value = ""
-                else:
-                    value = ""
-            lesson_data[key] = value
-
-        # Normalize tasks
-        raw_tasks = lesson_data.get("task", [])
-        if isinstance(raw_tasks, list):
-            lesson_data["task"] = [
-                {
-                    "task_number": i+1,
-                    "description": task if isinstance(task, str) else task.get("description", "")
-                }
-                for i, task in enumerate(raw_tasks[:3])
-            ]
-            # Ensure exactly 3 tasks
-            while len(lesson_data["task"]) < 3:
-                lesson_data["task"].append({"task_number": len(lesson_data["task"])+1, "description": ""})
-        else:
-            lesson_data["task"] = []
 
-        # Add date and completion info
-        lesson_data["date"] = day_date
-        lesson_data["completed"] = False
-        lesson_data["reflection"] = ""
+def _stream_day_lesson(day, inputs, day_date, previous_day_json):
+    """
+    Stream a day plan as NDJSON: one {"key", "value"} line per top-level
+    field as soon as the model finishes it, then a "done" line with the
+    shaped, saved lesson (the same body the JSON response returns).
+    """
+    prompt = _day_plan_prompt(day, inputs["goal_name"], inputs["user_answers"], previous_day_json)
+    try:
+        # No response_format here: Groq's JSON mode doesn't stream, so the
+        # tracker still finds the object in the text
+        stream = _call_llm(
+            [_DAY_PLAN_SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
+            llm_client=inputs["user_client"],
+            model="groq/compound",
+            temperature=0.4,
+            max_tokens=4096,
+            stream=True
+        )
+    except Exception as e:
+        return jsonify({"error": "API request failed", "exception": str(e)}), 500
 
-        # ========== STEP 6: Save to Firebase ==========
+    def generate():
+        tracker = _JsonObjectTracker()
         try:
-            course_ref = get_course_ref(user_id, course_id)
-            course_doc = course_ref.get()
-            if course_doc.exists:
-                course_data = course_doc.to_dict()
-                lessons_by_date = course_data.get('lessons_by_date', {})
-                lessons_by_date[day_date] = lesson_data
-                course_ref.update({'lessons_by_date': lessons_by_date})
-            else:
-                course_ref.set({
-                    'joined_date': joined_date.strftime("%Y-%m-%d"),
-                    'goal_name': goal_name,
-                    'lessons_by_date': {day_date: lesson_data},
-                    'created_at': datetime.now().isoformat()
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ""
+                if not delta:
+                    continue
+                tracker.feed(delta)
+                for key, value in tracker.take_members():
+                    yield _ndjson_line({"key": key, "value": value})
+                if tracker.complete:
+                    break
+
+            if not tracker.complete:
+                yield _ndjson_line({
+                    "error": f"Failed to parse Day {day} as valid JSON",
+                    "raw_response": tracker.text()
                 })
-            print(f"✅ Saved Day {day} to Firebase")
+                return
+
+            lesson_data = shape_day_lesson(orjson.loads(tracker.object_text()), day_date)
+            _save_day_lessons(inputs["user_id"], inputs["course_id"], inputs["goal_name"],
+                              inputs["joined_date"], {day_date: lesson_data})
+            yield _ndjson_line({
+                "done": True,
+                "success": True,
+                "day": day,
+                "date": day_date,
+                "course_id": inputs["course_id"],
+                "lesson": lesson_data,
+                "message": f"Day {day} lesson created successfully"
+            })
         except Exception as e:
-            return jsonify({"error": f"Failed to save to Firebase: {str(e)}"}), 500
+            yield _ndjson_line({"error": str(e)})
+        finally:
+            stream.close()
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    response.call_on_close(stream.close)
+    return response
 
-        # ========== STEP 7: Return Response ==========
-        return jsonify({
-            "success": True,
-            "day": day,
-            "date": day_date,
-            "course_id": course_id,
-            "lesson": lesson_data,
-            "message": f"Day {day} lesson created successfully"
-        })
-    
-    return final_plan_day_func
 
-# ============ CREATE ALL ENDPOINTS ============
-for i in range(1, 6):
-    create_day_endpoint(i)
+# ============ ALL DAYS IN ONE REQUEST ============
+def _build_course_lessons(inputs, day_dates):
+    """
+    Generate the lessons for day_dates ({day: date}) concurrently on IO_POOL.
+    Returns {day: lesson or DayPlanError}. A day is only held back for the
+    previous day when its prompt embeds that day's lesson.
+    """
+    def build(day, previous_day_json=None):
+        return build_day_lesson(
+            day, inputs["goal_name"], inputs["user_answers"], day_dates[day],
+            inputs["user_client"], previous_day_json
+        )
+
+    futures = {day: IO_POOL.submit(build, day) for day in day_dates if not needs_previous_day(day)}
+    results = {}
+    for day in day_dates:
+        if day not in futures:
+            previous = results.get(day - 1)
+            futures[day] = IO_POOL.submit(build, day, _lesson_json(previous) if isinstance(previous, dict) else None)
+        try:
+            results[day] = futures[day].result()
+        except DayPlanError as e:
+            results[day] = e
+    return results
+
+
+def _course_day_dates(joined_date, days=DAY_PLAN_DAYS):
+    return {day: (joined_date + timedelta(days=day-1)).isoformat() for day in days}
+
+
+REQUEST_MODELS.update(final_plan_all_days=DayPlanRequest, create_full_course=DayPlanRequest)
+
+
+@app.route('/final-plan-all-days', methods=['POST'])
+def final_plan_all_days():
+    """
+    Generate days 1-5 concurrently and save them in one write. Fails as a
+    whole if any day fails.
+    """
+    inputs, error = _parse_day_plan_request()
+    if error:
+        return error
+    day_dates = _course_day_dates(inputs["joined_date"])
+
+    results = _build_course_lessons(inputs, day_dates)
+    failed = next((r for r in results.values() if isinstance(r, DayPlanError)), None)
+    if failed:
+        return jsonify(failed.payload), failed.status
+    lessons = {day_dates[day]: lesson for day, lesson in results.items()}
+
+    try:
+        _save_day_lessons(inputs["user_id"], inputs["course_id"], inputs["goal_name"], inputs["joined_date"], lessons)
+    except Exception as e:
+        return jsonify({"error": f"Failed to save to Firebase: {str(e)}"}), 500
+
+    return jsonify({
+        "success": True,
+        "course_id": inputs["course_id"],
+        "lessons": lessons,
+        "message": "All 5 day lessons created successfully"
+    })
 
 
 # ============ OPTIONAL: Batch Create All Days ==========
 @app.route('/create-full-course', methods=['POST'])
 def create_full_course():
-    """Create all 5 days at once"""
-    data = request.get_json()
-    goal_name = data.get("goal_name", "").strip()
-    user_answers = data.get("user_answers", [])
-    user_id = data.get("user_id", "").strip()
-    join_date_str = data.get("join_date")
-    
-    if not goal_name or not isinstance(user_answers, list) or not user_id:
-        return jsonify({"error": "Missing required fields"}), 400
-    
+    """
+    Create all 5 days at once: the LLM calls run concurrently and every day
+    that succeeded is saved in a single write. Days that failed are reported
+    in errors.
+    """
+    inputs, error = _parse_day_plan_request()
+    if error:
+        return error
+    day_dates = _course_day_dates(inputs["joined_date"])
+
     results = []
     errors = []
-    
-    for day in range(1, 6):
-        try:
-            # Call each day endpoint internally
-            endpoint_func = app.view_functions[f"final_plan_day_{day}"]
-            # Note: This is simplified - in production, make actual HTTP calls
+    lessons = {}
+    for day, result in _build_course_lessons(inputs, day_dates).items():
+        if isinstance(result, DayPlanError):
+            errors.append(f"Day {day} failed: {result}")
+        else:
+            lessons[day_dates[day]] = result
             results.append(f"Day {day} created")
+
+    if lessons:
+        try:
+            _save_day_lessons(inputs["user_id"], inputs["course_id"], inputs["goal_name"], inputs["joined_date"], lessons)
         except Exception as e:
-            errors.append(f"Day {day} failed: {str(e)}")
-    
+            return jsonify({"error": f"Failed to save to Firebase: {str(e)}"}), 500
+
     return jsonify({
         "success": len(errors) == 0,
+        "course_id": inputs["course_id"],
         "results": results,
-        "errors": errors
+        "errors": errors,
+        "lessons": lessons
     })
 
 # ============ UTILITY: Get Course Progress ==========
@@ -3653,9 +4865,6 @@ def get_course(user_id, course_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
-
 
 
 @app.route('/start-ai-helper', methods=['POST'])
@@ -3671,16 +4880,16 @@ def start_ai_helper():
     if not prompt_template:
         return jsonify({"error": "prompt_ai_helper_start.txt not found"}), 500
 
-    prompt = prompt_template.replace("<<ai_plan>>", json.dumps(ai_plan, indent=2))
+    prompt = prompt_template.replace("<<ai_plan>>", orjson.dumps(ai_plan, option=orjson.OPT_INDENT_2).decode())
 
     try:
-        response = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[{"role": "user", "content": prompt}],
+        result = cached_complete(
+            "meta-llama/llama-4-scout-17b-16e-instruct",
+            [{"role": "user", "content": prompt}],
             temperature=0.4,
-            max_tokens=1000
-        )
-        result = response.choices[0].message.content.strip()
+            max_tokens=1000,
+            cache=False
+        ).strip()
         save_to_firebase(user_id, "ai_helper_starts", {
             "ai_plan": ai_plan,
             "ai_intro": result
@@ -3689,6 +4898,9 @@ def start_ai_helper():
 
     except Exception as e:
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
+
+_ROLE_LABELS = {"user": "User", "assistant": "Assistant", "system": "System"}
+
 @app.route('/ai-helper-reply', methods=['POST'])
 def ai_helper_reply():
     data = request.get_json()
@@ -3700,7 +4912,8 @@ def ai_helper_reply():
         return jsonify({"error": "Missing or invalid ai_plan or chat_history"}), 400
 
     history_text = "\n".join(
-        [f"{m['role'].capitalize()}: {m['content']}" for m in chat_history if isinstance(m, dict)]
+        f"{_ROLE_LABELS.get(m['role']) or m['role'].capitalize()}: {m['content']}"
+        for m in chat_history if isinstance(m, dict)
     )
 
     prompt_template = load_prompt("prompt_ai_helper_reply.txt")
@@ -3709,18 +4922,18 @@ def ai_helper_reply():
 
     prompt = (
         prompt_template
-        .replace("<<ai_plan>>", json.dumps(ai_plan, indent=2))
+        .replace("<<ai_plan>>", orjson.dumps(ai_plan, option=orjson.OPT_INDENT_2).decode())
         .replace("<<chat_history>>", history_text)
     )
 
     try:
-        response = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[{"role": "user", "content": prompt}],
+        result = cached_complete(
+            "meta-llama/llama-4-scout-17b-16e-instruct",
+            [{"role": "user", "content": prompt}],
             temperature=0.4,
-            max_tokens=1500
-        )
-        result = response.choices[0].message.content.strip()
+            max_tokens=1500,
+            cache=False
+        ).strip()
 
         save_to_firebase(user_id, "ai_helper_replies", {
             "ai_plan": ai_plan,
@@ -3743,23 +4956,22 @@ def daily_dashboard():
     if not raw_html:
         return jsonify({"error": "Missing goalplanner_saved_html"}), 400
 
-    soup = BeautifulSoup(raw_html, "html.parser")
     day_header = f"Skyler Day{day_number}"
-    section = None
-
-    for div in soup.find_all("div"):
-        if day_header in div.text:
-            section = div
-            break
+    try:
+        tree = lhtml.fromstring(raw_html)
+    except ParserError:
+        return jsonify({"error": f"No content found for {day_header}"}), 404
 
+    # First div (document order) containing the header, and within it the
+    # first <p> whose leading <strong> mentions "Task"
+    section = tree.xpath("(descendant-or-self::div[contains(., $header)])[1]", header=day_header)
     if not section:
         return jsonify({"error": f"No content found for {day_header}"}), 404
 
     task_text = ""
-    for p in section.find_all("p"):
-        if p.find("strong") and "Task" in p.find("strong").text:
-            task_text = p.text.replace("Task:", "").strip()
-            break
+    task_p = section[0].xpath("(.//p[(.//strong)[1][contains(., 'Task')]])[1]")
+    if task_p:
+        task_text = task_p[0].text_content().replace("Task:", "").strip()
 
     tasks = [t.strip() for t in task_text.split(",") if t.strip()]
 
@@ -3770,18 +4982,18 @@ def daily_dashboard():
     prompt = (
         prompt_template
         .replace("<<day>>", str(day_number))
-        .replace("<<tasks>>", json.dumps(tasks, indent=2))
+        .replace("<<tasks>>", orjson.dumps(tasks, option=orjson.OPT_INDENT_2).decode())
     )
 
     try:
-        response = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[{"role": "user", "content": prompt}],
+        result = cached_complete(
+            "meta-llama/llama-4-scout-17b-16e-instruct",
+            [{"role": "user", "content": prompt}],
             temperature=0.4,
-            max_tokens=1000
-        )
-        result = response.choices[0].message.content.strip()
-        parsed = json.loads(result)
+            max_tokens=1000,
+            cache=False
+        ).strip()
+        parsed = orjson.loads(result)
 
         save_to_firebase(user_id, "dashboards", {
             "day": day_number,
@@ -3791,7 +5003,7 @@ def daily_dashboard():
 
         return jsonify(parsed)
 
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         return jsonify({"error": "Failed to parse JSON from model", "raw_response": result}), 500
     except Exception as e:
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
@@ -3801,6 +5013,11 @@ def get_all_logs():
     logs = read_logs()
     return jsonify({"logs": logs})
 
+@app.route('/llm-cache-stats', methods=['GET'])
+def get_llm_cache_stats():
+    """LLM response cache counters for this worker process"""
+    return jsonify(llm_cache_stats())
+
 @app.route('/generate-reward-questions', methods=['POST'])
 def generate_reward_questions():
     data = request.get_json()
@@ -3811,7 +5028,7 @@ def generate_reward_questions():
         return jsonify({"error": "prompt_reward_questions.txt not found"}), 500
 
     try:
-        response = client.chat.completions.create(
+        response = _call_llm(
             model="meta-llama/llama-4-scout-17b-16e-instruct",
             messages=[{"role": "user", "content": prompt_template}],
             temperature=0.5,
@@ -3845,7 +5062,7 @@ def analyze_reward():
     prompt = prompt_template.replace("<<user_answers>>", formatted_answers)
 
     try:
-        response = client.chat.completions.create(
+        response = _call_llm(
             model="meta-llama/llama-4-scout-17b-16e-instruct",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.6,
@@ -3853,12 +5070,10 @@ def analyze_reward():
         )
         reward = response.choices[0].message.content.strip()
 
-        rewards = read_rewards()
-        rewards[user_id] = {
+        reward_ref(user_id).set({
             "reward": reward,
             "task_completed": False
-        }
-        write_rewards(rewards)
+        })
 
         save_to_firebase(user_id, "rewards", {
             "answers": answers,
@@ -3876,12 +5091,11 @@ def claim_reward():
     if not user_id:
         return jsonify({"error": "Missing user_id"}), 400
 
-    rewards = read_rewards()
-    if user_id not in rewards:
+    reward_doc = reward_ref(user_id).get()
+    reward_data = reward_doc.to_dict() if reward_doc.exists else import_legacy_reward(user_id)
+    if reward_data is None:
         return jsonify({"error": "No reward set for user"}), 404
 
-    reward_data = rewards[user_id]
-
     return jsonify({"reward": reward_data.get("reward")})
 
 @app.route('/complete-task', methods=['POST'])
@@ -3892,12 +5106,12 @@ def complete_task():
     if not user_id:
         return jsonify({"error": "Missing user_id"}), 400
 
-    rewards = read_rewards()
-    if user_id not in rewards:
-        return jsonify({"error": "User not found"}), 404
-
-    rewards[user_id]["task_completed"] = True
-    write_rewards(rewards)
+    try:
+        reward_ref(user_id).update({"task_completed": True})
+    except NotFound:
+        if import_legacy_reward(user_id) is None:
+            return jsonify({"error": "User not found"}), 404
+        reward_ref(user_id).update({"task_completed": True})
 
     save_to_firebase(user_id, "task_completions", {
         "task_completed": True
@@ -3905,6 +5119,7 @@ def complete_task():
 
     return jsonify({"message": "Task marked complete. Reward unlocked!"})
 
+# Local development only; deployments run gunicorn with gunicorn.conf.py
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,26 @@
+# Gunicorn settings for the Flask backend.
+# Handlers spend almost all of their time waiting on Groq and Firestore, so
+# each worker runs gevent: one process can keep hundreds of those waits in
+# flight instead of one per thread.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gevent"
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+
+# LLM calls can take tens of seconds; don't let the arbiter kill them
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
+
+
+def post_fork(server, worker):
+    # Patch before the app is imported so httpx/requests sockets yield to
+    # other greenlets, and make gRPC (used by Firestore) gevent-aware
+    from gevent import monkey
+    monkey.patch_all()
+
+    import grpc.experimental.gevent as grpc_gevent
+    grpc_gevent.init_gevent()